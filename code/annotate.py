@@ -1,83 +1,201 @@
+import os
 import pandas as pd
-import string
 from textwrap import wrap
-from utilities import order_hierarchy, extract_problems
+import xlsxwriter
+from xlsxwriter.utility import xl_col_to_name
+from utilities import order_hierarchy, extract_problems, write_jsonl
+from index import top_k_matches
 import numpy as np
 
 
-def create_excel(data, output_path, columns=None, labels=None):
-    labels = labels.copy()
-    if columns is None:
-        columns = list(data[0].keys())
-    column_types = {}
-    for label_letter, label_name in zip(string.ascii_uppercase, labels):
-        columns.append(label_name)
-        labels[label_name]["label_letter"] = label_letter
-    # TODO support more than A-Z columns
-    for column_letter, column_name in zip(string.ascii_uppercase, columns):
+# data rows per sheet, below the 1,048,576 row limit of Excel with the header
+MAX_SHEET_ROWS = 1000000
+
+
+class AnnotationSheetWriter:
+    # streams annotation rows into xlsx files in constant memory, one row at a
+    # time; each label becomes an empty column with a drop-down of its values,
+    # kept on a "labels" sheet, and rows past max_rows go to a new data sheet,
+    # or past max_sheets sheets to a new file named name-2.xlsx, name-3.xlsx...
+    def __init__(
+        self, output_path, columns, labels, max_rows=MAX_SHEET_ROWS, max_sheets=None
+    ):
+        self.output_path = output_path
+        self.labels = labels
+        self.data_columns = list(columns)
+        self.columns = self.data_columns + list(labels)
+        self.max_rows = max_rows
+        self.max_sheets = max_sheets
+        self.paths = []
+        self.workbook = None
+        self.worksheet = None
+        self.num_sheets = 0
+        self.num_rows = 0
+
+    def column_type(self, column_name):
         if column_name == "id" or column_name.endswith("_id"):
-            column_types[column_letter] = "id"
-        elif column_name in labels:
-            labels[column_name]["data_letter"] = column_letter
-            column_types[column_letter] = "label"
-        else:
-            column_types[column_letter] = "text"
-
-    df = pd.DataFrame(data=data, columns=columns)
-    df = df.fillna("")
-    df = df.set_index(columns[0])
-    data_size = len(df)
-    l_df = pd.DataFrame({l_name: l["values"] for l_name, l in labels.items()})
-
-    writer = pd.ExcelWriter(output_path, engine="xlsxwriter")
-    df.to_excel(writer, sheet_name="data")
-    l_df.to_excel(writer, sheet_name="labels", index=False)
-    workbook = writer.book
-    worksheet = writer.sheets["data"]
-    for label_name, label in labels.items():
-        data_letter = label["data_letter"]
-        label_letter = label["label_letter"]
-        label_values = label["values"]
-        label_message = label["message"]
-        worksheet.data_validation(
-            f"{data_letter}2:{data_letter}{data_size+1}",
+            return "id"
+        elif column_name in self.labels:
+            return "label"
+        return "text"
+
+    def new_workbook(self):
+        self.close_workbook()
+        path = self.output_path
+        if len(self.paths) > 0:
+            stem, ext = os.path.splitext(self.output_path)
+            path = f"{stem}-{len(self.paths) + 1}{ext}"
+        self.paths.append(path)
+        self.workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+        self.header_format = self.workbook.add_format({"bold": True, "border": 1})
+        self.text_format = self.workbook.add_format({"text_wrap": True})
+        self.num_sheets = 0
+
+    def new_sheet(self):
+        self.close_sheet()
+        if self.workbook is None or (
+            self.max_sheets is not None and self.num_sheets >= self.max_sheets
+        ):
+            self.new_workbook()
+        self.num_sheets += 1
+        name = "data" if self.num_sheets == 1 else f"data-{self.num_sheets}"
+        self.worksheet = self.workbook.add_worksheet(name)
+        self.num_rows = 0
+        for c_idx, column_name in enumerate(self.columns):
+            self.worksheet.write(0, c_idx, column_name, self.header_format)
+            column_type = self.column_type(column_name)
+            if column_type == "id":
+                self.worksheet.set_column(c_idx, c_idx, None, None, {"hidden": True})
+            elif column_type == "text":
+                self.worksheet.set_column(c_idx, c_idx, 55, self.text_format)
+            elif column_type == "label":
+                self.worksheet.set_column(c_idx, c_idx, 15)
+
+    def write(self, row):
+        if self.worksheet is None or self.num_rows >= self.max_rows:
+            self.new_sheet()
+        self.num_rows += 1
+        for c_idx, column_name in enumerate(self.data_columns):
+            value = row.get(column_name)
+            if value is not None and value != "":
+                self.worksheet.write(self.num_rows, c_idx, value)
+
+    def close_sheet(self):
+        if self.worksheet is None:
+            return
+        # drop-downs on the label columns of every data row
+        for l_idx, (label_name, label) in enumerate(self.labels.items()):
+            c_idx = len(self.data_columns) + l_idx
+            label_column = xl_col_to_name(l_idx)
+            self.worksheet.data_validation(
+                1,
+                c_idx,
+                max(self.num_rows, 1),
+                c_idx,
+                {
+                    "validate": "list",
+                    "source": f"=labels!${label_column}$2:"
+                    f"${label_column}${len(label['values']) + 1}",
+                    "input_message": label["message"],
+                },
+            )
+        self.worksheet = None
+
+    def close_workbook(self):
+        self.close_sheet()
+        if self.workbook is not None:
+            # the data sheets only refer to it by name, so it can come last
+            labels_sheet = self.workbook.add_worksheet("labels")
+            for l_idx, (label_name, label) in enumerate(self.labels.items()):
+                labels_sheet.write(0, l_idx, label_name, self.header_format)
+                for v_idx, value in enumerate(label["values"], start=1):
+                    labels_sheet.write(v_idx, l_idx, value)
+            self.workbook.close()
+            self.workbook = None
+
+    def close(self):
+        if len(self.paths) == 0:
+            # an empty sheet, so there is still a file to annotate
+            self.new_sheet()
+        self.close_workbook()
+        return self.paths
+
+
+def create_excel(
+    data, output_path, columns=None, labels=None, max_rows=MAX_SHEET_ROWS, max_sheets=None
+):
+    # data is any iterable of dicts, e.g. a generator, so it is never held in
+    # memory; without columns they are taken from the first row
+    data = iter(data)
+    first = next(data, None)
+    if columns is None:
+        columns = [] if first is None else list(first.keys())
+    writer = AnnotationSheetWriter(
+        output_path, columns, labels or {}, max_rows=max_rows, max_sheets=max_sheets
+    )
+    if first is not None:
+        writer.write(first)
+    for row in data:
+        writer.write(row)
+    return writer.close()
+
+
+def cosine(a, b):
+    # row-wise cosine similarity of two equally shaped matrices
+    norms = np.linalg.norm(a, axis=-1) * np.linalg.norm(b, axis=-1)
+    return np.sum(a * b, axis=-1) / np.maximum(norms, 1e-8)
+
+
+def reference_report(f_embs, r_embs, f_counts, thresholds=(0.5, 0.6, 0.7, 0.8, 0.9)):
+    # how well discovered frames line up with the known reference frames at a
+    # range of cosine similarity thresholds: precision is the share of
+    # discovered frames (or of their tweets, weighted) whose closest known
+    # frame is at least that similar, coverage the share of known frames with
+    # a discovered frame at least that similar
+    f_counts = np.asarray(f_counts, dtype=np.float64)
+    total = f_counts.sum()
+    if len(f_embs) > 0 and len(r_embs) > 0:
+        f_ids, _ = top_k_matches(f_embs, r_embs, k=1)
+        f_ids = f_ids[:, 0]
+        f_sims = cosine(f_embs, r_embs[f_ids])
+        r_ids, _ = top_k_matches(r_embs, f_embs, k=1)
+        r_sims = cosine(r_embs, f_embs[r_ids[:, 0]])
+    else:
+        # nothing to match, every share is reported as 0.0
+        f_ids = np.zeros(shape=[len(f_embs)], dtype=np.int64)
+        f_sims = np.full(shape=[len(f_embs)], fill_value=-np.inf)
+        r_sims = np.full(shape=[len(r_embs)], fill_value=-np.inf)
+    rows = []
+    for threshold in thresholds:
+        matched = f_sims >= threshold
+        rows.append(
             {
-                "validate": "list",
-                "source": f"=labels!${label_letter}$2:${label_letter}${len(label_values)+1}",
-                "input_message": label_message,
-            },
+                "threshold": threshold,
+                "precision": matched.mean() if len(matched) > 0 else 0.0,
+                "weighted_precision": (
+                    f_counts[matched].sum() / total if total > 0 else 0.0
+                ),
+                "coverage": np.mean(r_sims >= threshold) if len(r_sims) > 0 else 0.0,
+                "matched_references": len(np.unique(f_ids[matched])),
+            }
         )
-    cell_format = workbook.add_format()
-    cell_format.set_text_wrap()
-    for column_letter, column_type in column_types.items():
-        column_range = f"{column_letter}:{column_letter}"
-        # first_col, last_col, width, cell_format, options
-        if column_type == "id":
-            worksheet.set_column(column_range, options={"hidden": True})
-        elif column_type == "text":
-            worksheet.set_column(column_range, cell_format=cell_format, width=55)
-        elif column_type == "label":
-            worksheet.set_column(column_range, width=15)
-
-    writer.close()
-
-
-def annotate_frames(frames, relations, counts, name, embed, ref_frames):
+    return pd.DataFrame(rows)
+
+
+def annotate_frames(
+    frames, relations, counts, name, embed, ref_frames, k=3, tagger=None
+):
     r_embs = embed.encode([f["text"] for f in ref_frames])
     samples = []
-    fs = list(order_hierarchy(frames, relations, counts))
+    fs = order_hierarchy(frames, relations, counts, unique=True)
     fs_embs = embed.encode([f["text"] for f_id, f in fs])
-    # TODO grab closest known framing by emb distance
-    seen_f_ids = set()
-    for (f_id, f), f_emb in zip(fs, fs_embs):
-        if f_id in seen_f_ids:
-            continue
-        seen_f_ids.add(f_id)
+    m_ids, _ = top_k_matches(fs_embs, r_embs, k=k)
+    matches = []
+    for (f_id, f), f_emb, cf_idxs in zip(fs, fs_embs, m_ids):
         fc = counts[f_id]
-        problems = extract_problems(f)
+        problems = extract_problems(f, tagger)
         p_str = ", ".join([p.title() for p in problems])
-        cf_idx = np.argmin(np.sum((f_emb[None, :] - r_embs) ** 2, axis=-1))
-        cf = ref_frames[cf_idx]
+        cf = ref_frames[cf_idxs[0]]
         samples.append(
             {
                 "f_id": f_id,
@@ -88,9 +206,22 @@ def annotate_frames(frames, relations, counts, name, embed, ref_frames):
                 "ref_text": "\n".join(wrap(cf["text"], 50)),
             }
         )
+        matches.append(
+            {
+                "f_id": f_id,
+                "ref_f_ids": [ref_frames[idx]["f_id"] for idx in cf_idxs],
+                "similarities": cosine(f_emb[None, :], r_embs[cf_idxs]).tolist(),
+            }
+        )
+    output_path = os.path.splitext(name)[0]
+    write_jsonl(matches, output_path + "-matches.jsonl")
+    if len(fs) > 0 and len(ref_frames) > 0:
+        report = reference_report(fs_embs, r_embs, [counts[f_id] for f_id, f in fs])
+        print(report.to_string(index=False))
+        report.to_csv(output_path + "-coverage.csv", index=False)
     # Same or specialize or contradict
     #
-    print(len(seen_f_ids))
+    print(len(fs))
     create_excel(
         samples,
         name,
@@ -115,30 +246,35 @@ def annotate_frames(frames, relations, counts, name, embed, ref_frames):
     )
 
 
-def annotate_relations(frames, relations, counts, name):
-    samples = []
-    rs = sorted(relations, key=lambda x: (x["x"], x["y"]))
-    for rel in rs:
-        fx = frames[rel["x"]]
-        fy = frames[rel["y"]]
-        ts = rel["type"].title()
-        r_id = f"{rel['type']}-{rel['x']}-{rel['y']}"
+def annotate_relations(frames, relations, counts, name, max_rows=MAX_SHEET_ROWS):
+    wrapped = {}
 
-        samples.append(
-            {
+    def wrapped_text(f_idx):
+        # frames take part in many relations, so each is wrapped once
+        if f_idx not in wrapped:
+            wrapped[f_idx] = "\n".join(wrap(frames[f_idx]["text"], 50))
+        return wrapped[f_idx]
+
+    def samples():
+        for rel in sorted(relations, key=lambda x: (x["x"], x["y"])):
+            ts = rel["type"].title()
+            r_id = f"{rel['type']}-{rel['x']}-{rel['y']}"
+            yield {
                 "r_id": r_id,
-                "fx_text": "\n".join(wrap(fx["text"], 50)),
+                "fx_text": wrapped_text(rel["x"]),
                 "ts_text": ts,
-                "fy_text": "\n".join(wrap(fy["text"], 50)),
+                "fy_text": wrapped_text(rel["y"]),
             }
-        )
-    create_excel(
-        samples,
+
+    return create_excel(
+        samples(),
         name,
+        columns=["r_id", "fx_text", "ts_text", "fy_text"],
         labels={
             "Correct": {
                 "values": ["Yes", "No"],
                 "message": "Is this discovered relation correct?",
             },
         },
+        max_rows=max_rows,
     )
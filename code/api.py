@@ -1,5 +1,8 @@
 from abc import ABC, abstractmethod
-import os
+from collections import deque
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from functools import lru_cache
+import threading
 import time
 from hashlib import sha512
 
@@ -7,22 +10,228 @@ import openai
 import ujson as json
 import replicate
 
+from cache import ResponseCache, FileCache
+from metrics import APIMetrics
+from ratelimit import (
+    RateLimiter,
+    is_retryable,
+    is_config_error,
+    retry_after,
+    backoff_delay,
+)
+
+
+# answer given in place of a request the provider rejected outright, so the
+# example is written with no frames instead of stopping the run
+EMPTY_ANSWER = {"role": "assistant", "content": ""}
+
+
+class RequestRejected(Exception):
+    # a fatal error of one request, as opposed to the api configuration
+    pass
+
+
+@lru_cache(maxsize=4096)
+def message_digest(role, content):
+    # few-shot prompt messages are the same str objects on every call, so
+    # after the first call their digests come straight from this cache
+    return sha512(f"{role}\n{content}".encode()).digest()
+
 
 class ChatAPI(ABC):
-    def __init__(self, api_key: str = None, cache_path: str = None):
+    backend = None
+
+    def __init__(
+        self,
+        api_key: str = None,
+        cache_path: str = None,
+        rate_limiter: RateLimiter = None,
+        max_retries: int = 8,
+        backoff_seconds: float = 2,
+        cache: ResponseCache = None,
+        legacy_cache: ResponseCache = None,
+    ):
         self.api_key = api_key
         self.cache_path = cache_path
+        if cache is None and cache_path is not None:
+            cache = FileCache(cache_path)
+        self.cache = cache
+        self.legacy_cache = legacy_cache
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.metrics = APIMetrics()
+
+    def cache_key(self, messages):
+        # content-addressed on everything that changes the completion
+        params = [self.backend, self.api_model, self.temperature, self.max_tokens]
+        h = sha512(json.dumps(params).encode())
+        for message in messages:
+            h.update(message_digest(message["role"], message["content"]))
+        return h.hexdigest()
+
+    @classmethod
+    def resolve_model(cls, model):
+        # provider model name sent with requests and used in cache keys
+        return model
+
+    def legacy_cache_key(self, messages):
+        # key used by caches written before model parameters were part of the key
+        return sha512(json.dumps(messages, sort_keys=True).encode()).hexdigest()
+
+    def cached(self, messages, hash_key):
+        start = time.perf_counter()
+        api_response = self.cache.get(hash_key)
+        if api_response is None and self.legacy_cache is not None:
+            api_response = self.legacy_cache.get(self.legacy_cache_key(messages))
+            if api_response is not None:
+                self.cache.put(hash_key, api_response)
+        self.metrics.record_cache(
+            api_response is not None, time.perf_counter() - start
+        )
+        return api_response
+
+    def store(self, hash_key, api_response):
+        start = time.perf_counter()
+        self.cache.put(hash_key, api_response)
+        self.metrics.record_cache_write(time.perf_counter() - start)
+
+    def send(self, messages, stop_when=None):
+        # check to see if we have a cached api response
+        hash_key = self.cache_key(messages)
+        if self.cache is not None:
+            api_response = self.cached(messages, hash_key)
+            if api_response is not None:
+                return self.process_response(api_response)
+        try:
+            api_response = self.complete(messages, stop_when)
+        except RequestRejected:
+            # not cached, so a later run with other settings asks again
+            return dict(EMPTY_ANSWER)
+        if self.cache is not None:
+            self.store(hash_key, api_response)
+        return self.process_response(api_response)
+
+    @abstractmethod
+    def create(self, messages, stop_when=None):
+        # single raw request to the provider, retried by complete; streaming
+        # backends may end generation once stop_when(text) returns an offset
+        pass
 
     @abstractmethod
-    def send(self, messages):
+    def process_response(self, response):
         pass
 
+    def response_usage(self, response):
+        # prompt and completion token counts reported by the provider
+        return response.get("usage")
+
+    def estimate_tokens(self, messages):
+        # rough prompt size plus the completion budget, for tokens-per-minute limits
+        return sum(len(m["content"]) for m in messages) // 4 + self.max_tokens
+
+    def complete(self, messages, stop_when=None):
+        tokens = self.estimate_tokens(messages)
+        attempt = 0
+        while True:
+            self.metrics.record_sleep(self.rate_limiter.acquire(tokens))
+            start = time.perf_counter()
+            try:
+                response = self.create(messages, stop_when)
+                self.metrics.record_call(
+                    time.perf_counter() - start, self.response_usage(response)
+                )
+                return response
+            except Exception as e:
+                if not is_retryable(e):
+                    self.metrics.record_failure(e)
+                    if is_config_error(e):
+                        print(f"{type(e).__name__}: {e} (not retryable)")
+                        raise
+                    print(f"{type(e).__name__}: {e} (skipping request)")
+                    raise RequestRejected(str(e)) from e
+                if attempt >= self.max_retries:
+                    self.metrics.record_failure(e)
+                    print(f"{type(e).__name__}: {e} (giving up after {attempt} retries)")
+                    raise
+                self.metrics.record_retry(e)
+                wait = retry_after(e)
+                delay = backoff_delay(
+                    attempt, self.backoff_seconds, retry_after_seconds=wait
+                )
+                if wait is not None:
+                    self.rate_limiter.pause(wait)
+                print(f"{type(e).__name__}: {e} (retrying in {delay:.0f}s)")
+                time.sleep(delay)
+                self.metrics.record_sleep(delay)
+                attempt += 1
+
     @abstractmethod
     def build_message(self, text: str):
         pass
 
+    def close(self):
+        # persists the sqlite counters, the legacy cache may be the same one
+        for cache in {id(c): c for c in [self.cache, self.legacy_cache]}.values():
+            if cache is not None:
+                cache.close()
+
+
+class StreamedCompletion:
+    # collects streamed chat completion chunks into the non-streamed response
+    # shape, ending early once stop_when(text) returns where the answer ends
+    def __init__(self, api_model, stop_when=None):
+        self.api_model = api_model
+        self.stop_when = stop_when
+        self.parts = []
+        self.num_chunks = 0
+        self.finish_reason = None
+        self.usage = None
+
+    def add(self, chunk):
+        # returns True once the answer is complete and the stream can be closed
+        self.usage = chunk.get("usage") or self.usage
+        if not chunk["choices"]:
+            return False
+        choice = chunk["choices"][0]
+        delta = choice["delta"].get("content")
+        self.finish_reason = choice.get("finish_reason") or self.finish_reason
+        if not delta:
+            return False
+        self.parts.append(delta)
+        self.num_chunks += 1
+        if self.stop_when is None:
+            return False
+        text = "".join(self.parts)
+        end = self.stop_when(text)
+        if end is None:
+            return False
+        self.parts = [text[:end]]
+        self.finish_reason = "stop_when"
+        return True
+
+    def response(self):
+        usage = self.usage
+        if usage is None:
+            # one streamed chunk per generated token
+            usage = {"prompt_tokens": None, "completion_tokens": self.num_chunks}
+        return {
+            "object": "chat.completion",
+            "model": self.api_model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(self.parts)},
+                    "finish_reason": self.finish_reason,
+                }
+            ],
+            "usage": usage,
+        }
+
 
 class OpenAIAPI(ChatAPI):
+    backend = "openai"
+
     def __init__(
         self,
         model: str,
@@ -33,9 +242,23 @@ class OpenAIAPI(ChatAPI):
         cache_path: str = None,
         base_api: str = None,
         system_as_user_prompt: bool = False,
+        rate_limiter: RateLimiter = None,
+        max_retries: int = 8,
+        cache: ResponseCache = None,
+        legacy_cache: ResponseCache = None,
+        stream: bool = False,
     ):
-        super().__init__(api_key, cache_path)
-        openai.api_key = self.api_key
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(rpm=60 / max(delay_seconds, 1e-3))
+        super().__init__(
+            api_key,
+            cache_path,
+            rate_limiter,
+            max_retries,
+            backoff_seconds=max(delay_seconds, 1),
+            cache=cache,
+            legacy_cache=legacy_cache,
+        )
         self.model = model
         self.temperature = temperature
         self.max_tokens = max_tokens
@@ -43,47 +266,39 @@ class OpenAIAPI(ChatAPI):
         self.base_api = base_api
         self.api_model = self.model
         self.system_as_user_prompt = system_as_user_prompt
-        if self.base_api is not None:
-            openai.api_base = self.base_api
-        
-    def send(self, messages):
-        # check to see if we have a cached api response
-        hash_key = sha512(json.dumps(messages, sort_keys=True).encode()).hexdigest()
-        if self.cache_path is not None:
-            cache_file = os.path.join(self.cache_path, f"{hash_key}.json")
-            if os.path.exists(cache_file):
-                with open(cache_file, "r") as f:
-                    api_response = json.load(f)
-                response = self.process_response(api_response)
-                return response
-        while True:
-            try:
-                if self.system_as_user_prompt:
-                    messages = [
-                        # system prompt, task prompt, and example prompt all together
-                        {"role": "user", "content": "\n".join([c["content"] for c in messages[:3]])},
-                    ] + messages[3:]
-
-
-                api_response = openai.ChatCompletion.create(
-                    model=self.api_model,
-                    messages=messages,
-                    temperature=self.temperature,
-                    max_tokens=self.max_tokens,
-                )
-                # rate limit requests
-                time.sleep(self.delay_seconds)
-                break
-            except Exception as e:
-                print(e)
-                # rate limit errors more aggressively
-                time.sleep(max(self.delay_seconds * 5, 30))
-        if self.cache_path is not None:
-            cache_file = os.path.join(self.cache_path, f"{hash_key}.json")
-            with open(cache_file, "w") as f:
-                json.dump(api_response, f)
-        response = self.process_response(api_response)
-        return response
+        self.stream = stream
+
+    def prepare_messages(self, messages):
+        if self.system_as_user_prompt:
+            messages = [
+                # system prompt, task prompt, and example prompt all together
+                {"role": "user", "content": "\n".join([c["content"] for c in messages[:3]])},
+            ] + messages[3:]
+        return messages
+
+    def create(self, messages, stop_when=None):
+        # key and base url are passed per call, not set on the openai module,
+        # so instances for different endpoints can share one process
+        response = openai.ChatCompletion.create(
+            model=self.api_model,
+            messages=self.prepare_messages(messages),
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            api_key=self.api_key,
+            api_base=self.base_api,
+            stream=self.stream,
+        )
+        if not self.stream:
+            return response
+        # closing the stream drops the connection, so the server stops generating
+        completion = StreamedCompletion(self.api_model, stop_when)
+        try:
+            for chunk in response:
+                if completion.add(chunk):
+                    break
+        finally:
+            response.close()
+        return completion.response()
 
     def build_message(self, text: str):
         return {"role": "user", "content": text}
@@ -96,24 +311,47 @@ class OpenAIAPI(ChatAPI):
         return message
 
 class DeepInfraAPI(OpenAIAPI):
+    backend = "deepinfra"
     deepinfra_models = {
         "llama-2": "meta-llama/Llama-2-70b-chat-hf"
     }
-    def __init__(self, model: str, temperature: float = 0, max_tokens: int = 512, delay_seconds: int = 6, api_key: str = None, cache_path: str = None, base_api: str = "https://api.deepinfra.com/v1/openai"):
-        super().__init__(model, temperature, max_tokens, delay_seconds, api_key, cache_path, base_api, system_as_user_prompt = True)
-        self.api_model = self.deepinfra_models[self.model]
+    def __init__(self, model: str, temperature: float = 0, max_tokens: int = 512, delay_seconds: int = 6, api_key: str = None, cache_path: str = None, base_api: str = "https://api.deepinfra.com/v1/openai", rate_limiter: RateLimiter = None, max_retries: int = 8, cache: ResponseCache = None, legacy_cache: ResponseCache = None, stream: bool = False):
+        super().__init__(model, temperature, max_tokens, delay_seconds, api_key, cache_path, base_api, system_as_user_prompt = True, rate_limiter = rate_limiter, max_retries = max_retries, cache = cache, legacy_cache = legacy_cache, stream = stream)
+        self.api_model = self.resolve_model(self.model)
+
+    @classmethod
+    def resolve_model(cls, model):
+        return cls.deepinfra_models[model]
 
 
 class FastChatAPI(OpenAIAPI):
+    backend = "fastchat"
     fastchat_models = {
         "vicuna": "vicuna-13b-v1.5"
     }
-    def __init__(self, model: str, temperature: float = 0, max_tokens: int = 512, delay_seconds: int = 1, api_key: str = None, cache_path: str = None, base_api: str = "http://localhost:8000/v1"):
+    def __init__(self, model: str, temperature: float = 0, max_tokens: int = 512, delay_seconds: int = 1, api_key: str = None, cache_path: str = None, base_api: str = "http://localhost:8000/v1", rate_limiter: RateLimiter = None, max_retries: int = 8, cache: ResponseCache = None, legacy_cache: ResponseCache = None, stream: bool = False):
         api_key = "EMPTY"
-        super().__init__(model, temperature, max_tokens, delay_seconds, api_key, cache_path, base_api, system_as_user_prompt = False)
-        self.api_model = self.fastchat_models[self.model]
+        super().__init__(model, temperature, max_tokens, delay_seconds, api_key, cache_path, base_api, system_as_user_prompt = False, rate_limiter = rate_limiter, max_retries = max_retries, cache = cache, legacy_cache = legacy_cache, stream = stream)
+        self.api_model = self.resolve_model(self.model)
+
+    @classmethod
+    def resolve_model(cls, model):
+        return cls.fastchat_models[model]
+
+class ReplicateJob:
+    def __init__(self, messages, hash_key, future):
+        self.messages = messages
+        self.hash_key = hash_key
+        self.future = future
+        self.prediction = None
+        self.submitted = None
+        self.attempt = 0
+        # earliest time to (re)submit, for backoff after errors
+        self.not_before = 0.0
+
 
 class ReplicateAPI(ChatAPI):
+    backend = "replicate"
     replicate_models = {
         "llama-2": "meta/llama-2-70b-chat:02e509c789964a7ea8736978a43525956ef40397be9033abf9fd2badfe68c9e3",
         "vicuna-13b": "6282abe6a492de4145d7bb601023762212f9ddbbe78278bd6771c8b3b2f2a13b"
@@ -126,16 +364,53 @@ class ReplicateAPI(ChatAPI):
         delay_seconds: int = 6,
         api_key: str = None,
         cache_path: str = None,
+        rate_limiter: RateLimiter = None,
+        max_retries: int = 8,
+        cache: ResponseCache = None,
+        legacy_cache: ResponseCache = None,
+        pipeline: bool = False,
+        max_inflight: int = 32,
+        poll_interval: float = 2,
+        poll_workers: int = 8,
+        deadline_seconds: float = 600,
     ):
-        super().__init__(api_key, cache_path)
-        os.environ["REPLICATE_API_TOKEN"] = self.api_key
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(rpm=60 / max(delay_seconds, 1e-3))
+        super().__init__(
+            api_key,
+            cache_path,
+            rate_limiter,
+            max_retries,
+            backoff_seconds=max(delay_seconds, 1),
+            cache=cache,
+            legacy_cache=legacy_cache,
+        )
+        self.client = replicate.Client(api_token=self.api_key)
 
         self.model = model
-        self.replicate_model = self.replicate_models[self.model]
+        self.replicate_model = self.resolve_model(self.model)
+        self.api_model = self.replicate_model
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.delay_seconds = delay_seconds
+        # with pipeline, submit() queues predictions that one thread creates
+        # up to max_inflight at a time and polls together, instead of one
+        # blocking wait() per request
+        self.is_async = pipeline
+        self.max_inflight = max_inflight
+        self.poll_interval = poll_interval
+        self.poll_workers = poll_workers
+        self.deadline_seconds = deadline_seconds
+        self.queue = deque()
+        self.queue_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pipeline_thread = None
+        self.closed = False
     
+    @classmethod
+    def resolve_model(cls, model):
+        return cls.replicate_models[model]
+
     def build_prompt(self, messages):
         system_prompt = messages[0]["content"]
         prompt_lines = []
@@ -146,54 +421,179 @@ class ReplicateAPI(ChatAPI):
                 prompt_lines.append(message["content"])
         prompt = "\n".join(prompt_lines)
         return system_prompt, prompt
+
+    def create_prediction(self, messages):
+        system_prompt, prompt = self.build_prompt(messages)
+        return self.client.predictions.create(
+            self.replicate_model,
+            input={
+                "system_prompt": system_prompt,
+                "prompt": prompt,
+                "temperature": 0.01 if self.temperature == 0 else self.temperature,
+                "max_new_tokens": self.max_tokens,
+                "max_length": 4096,
+            },
+        )
     
-    def send(self, messages):
-        # check to see if we have a cached api response
-        hash_key = sha512(json.dumps(messages, sort_keys=True).encode()).hexdigest()
-        if self.cache_path is not None:
-            cache_file = os.path.join(self.cache_path, f"{hash_key}.json")
-            if os.path.exists(cache_file):
-                with open(cache_file, "r") as f:
-                    api_response = json.load(f)
-                response = self.process_response(api_response)
-                return response
-        while True:
-            try:
+    def create(self, messages, stop_when=None):
+        prediction = self.create_prediction(messages)
+        prediction.wait()
+        api_response = dict(prediction)
+        if api_response["error"] is not None:
+            raise Exception(api_response["error"])
+        return api_response
 
-                system_prompt, prompt = self.build_prompt(messages)
-                prediction = replicate.predictions.create(
-                    self.replicate_model,
-                    input={
-                        "system_prompt": system_prompt,
-                        "prompt": prompt,
-                        "temperature": 0.01 if self.temperature == 0 else self.temperature,
-                        "max_new_tokens": self.max_tokens,
-                        "max_length": 4096,
-                    },
+    def submit(self, messages, stop_when=None):
+        future = Future()
+        hash_key = self.cache_key(messages)
+        if self.cache is not None:
+            api_response = self.cached(messages, hash_key)
+            if api_response is not None:
+                future.set_result(self.process_response(api_response))
+                return future
+        with self.queue_lock:
+            self.queue.append(ReplicateJob(messages, hash_key, future))
+            if self.pipeline_thread is None:
+                self.pipeline_thread = threading.Thread(
+                    target=self.run_pipeline, daemon=True
                 )
+                self.pipeline_thread.start()
+        self.wakeup.set()
+        return future
 
-                prediction.wait()
-                api_response = dict(prediction)
-                if api_response["error"] is not None:
-                    raise Exception(api_response["error"])
+    def run_pipeline(self):
+        active = []
+        with ThreadPoolExecutor(max_workers=self.poll_workers) as executor:
+            while not self.closed:
+                try:
+                    self.fill(active)
+                    if not active:
+                        self.wakeup.wait(self.poll_interval)
+                        self.wakeup.clear()
+                        continue
+                    time.sleep(self.poll_interval)
+                    # predictions are reloaded concurrently, one GET each
+                    list(executor.map(self.reload, active))
+                    active[:] = [job for job in active if not self.collect(job)]
+                except Exception as e:
+                    # every later submit waits on this thread, so it must outlive
+                    # any one job; unfinished jobs are picked up next round
+                    print(f"{type(e).__name__}: {e} (replicate pipeline)")
 
-                # rate limit requests
-                time.sleep(self.delay_seconds)
-                break
+    def fill(self, active):
+        # creates queued predictions while under the in-flight limit
+        now = time.monotonic()
+        while len(active) < self.max_inflight:
+            with self.queue_lock:
+                ready = [job for job in self.queue if job.not_before <= now]
+                if not ready:
+                    return
+                job = ready[0]
+                self.queue.remove(job)
+            # once running the future cannot be cancelled, so it can always be
+            # resolved; a retried job is running already
+            if not job.future.running():
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+            wait = self.rate_limiter.reserve(self.estimate_tokens(job.messages))
+            if wait > 0:
+                time.sleep(wait)
+                self.metrics.record_sleep(wait)
+            try:
+                job.prediction = self.create_prediction(job.messages)
             except Exception as e:
-                print(e)
-                # rate limit errors more aggressively
-                time.sleep(max(self.delay_seconds * 5, 30))
-        if self.cache_path is not None:
-            cache_file = os.path.join(self.cache_path, f"{hash_key}.json")
-            with open(cache_file, "w") as f:
-                json.dump(api_response, f)
-        response = self.process_response(api_response)
-        return response
+                self.retry(job, e)
+                continue
+            job.submitted = time.monotonic()
+            active.append(job)
+
+    def reload(self, job):
+        try:
+            job.prediction.reload()
+        except Exception as e:
+            # a failed poll is tried again on the next round
+            print(f"{type(e).__name__}: {e} (polling {job.prediction.id})")
+
+    @staticmethod
+    def resolve(future, result=None, error=None):
+        try:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            # resolved or cancelled by someone else in the meantime
+            pass
+
+    def collect(self, job):
+        # returns True once the job has left the in-flight set
+        status = job.prediction.status
+        if status == "succeeded":
+            api_response = dict(job.prediction)
+            self.metrics.record_call(
+                time.monotonic() - job.submitted, self.response_usage(api_response)
+            )
+            if self.cache is not None:
+                self.store(job.hash_key, api_response)
+            self.resolve(job.future, self.process_response(api_response))
+            return True
+        if status in ["failed", "canceled"]:
+            self.retry(job, Exception(job.prediction.error or status))
+            return True
+        if time.monotonic() - job.submitted > self.deadline_seconds:
+            # straggler, usually stuck in a cold start or a slow queue
+            try:
+                job.prediction.cancel()
+            except Exception:
+                pass
+            self.retry(
+                job,
+                TimeoutError(
+                    f"Prediction {job.prediction.id} exceeded {self.deadline_seconds}s"
+                ),
+            )
+            return True
+        return False
+
+    def retry(self, job, e):
+        if not is_retryable(e) and not is_config_error(e):
+            self.metrics.record_failure(e)
+            print(f"{type(e).__name__}: {e} (skipping request)")
+            self.resolve(job.future, dict(EMPTY_ANSWER))
+            return
+        if not is_retryable(e) or job.attempt >= self.max_retries:
+            self.metrics.record_failure(e)
+            print(f"{type(e).__name__}: {e} (giving up after {job.attempt} retries)")
+            self.resolve(job.future, error=e)
+            return
+        self.metrics.record_retry(e)
+        wait = retry_after(e)
+        delay = backoff_delay(job.attempt, self.backoff_seconds, retry_after_seconds=wait)
+        if wait is not None:
+            self.rate_limiter.pause(wait)
+        print(f"{type(e).__name__}: {e} (resubmitting in {delay:.0f}s)")
+        job.attempt += 1
+        job.not_before = time.monotonic() + delay
+        with self.queue_lock:
+            self.queue.append(job)
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        super().close()
 
     def build_message(self, text: str):
         return {"role": "user", "content": text}
 
+    def response_usage(self, response):
+        metrics = response.get("metrics") or {}
+        if "input_token_count" not in metrics:
+            return None
+        return {
+            "prompt_tokens": metrics["input_token_count"],
+            "completion_tokens": metrics.get("output_token_count", 0),
+        }
+
     def process_response(self, response):
         message = {
             "role": "assistant",
@@ -202,3 +602,43 @@ class ReplicateAPI(ChatAPI):
         return message
 
 
+class ReplayAPI(ChatAPI):
+    # answers only from responses cached by another backend, with no client,
+    # no rate limiting and no sleeps; a miss is recorded and returned as None
+    def __init__(
+        self,
+        api_cls,
+        model: str,
+        temperature: float = 0,
+        max_tokens: int = 512,
+        cache: ResponseCache = None,
+        legacy_cache: ResponseCache = None,
+    ):
+        super().__init__(cache=cache, legacy_cache=legacy_cache)
+        self.api_cls = api_cls
+        # keys must match the ones the replayed backend wrote
+        self.backend = api_cls.backend
+        self.model = model
+        self.api_model = api_cls.resolve_model(model)
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.lock = threading.Lock()
+        self.misses = []
+
+    def send(self, messages, stop_when=None):
+        hash_key = self.cache_key(messages)
+        api_response = self.cached(messages, hash_key)
+        if api_response is None:
+            with self.lock:
+                self.misses.append(hash_key)
+            return None
+        return self.process_response(api_response)
+
+    def create(self, messages, stop_when=None):
+        raise RuntimeError("Replay does not send requests")
+
+    def build_message(self, text: str):
+        return self.api_cls.build_message(self, text)
+
+    def process_response(self, response):
+        return self.api_cls.process_response(self, response)
@@ -2,8 +2,22 @@ import argparse
 import os
 from tqdm import tqdm
 
-from utilities import read_jsonl, write_jsonl, format_text, extract_frames, build_api
-from collections import defaultdict
+from dedup import build_deduper
+from utilities import (
+    read_jsonl,
+    iter_jsonl,
+    write_jsonl,
+    format_text,
+    extract_frames,
+    articulation_complete,
+    build_api,
+    send_all,
+    ArticulationWriter,
+    rebuild_articulations,
+    write_unique_articulations,
+    shard_of,
+    shard_name,
+)
 
 
 if __name__ == "__main__":
@@ -12,6 +26,16 @@ if __name__ == "__main__":
     arg_parser.add_argument("--method", type=str)
     arg_parser.add_argument("--api", type=str)
     arg_parser.add_argument("--api_key", type=str, default=None)
+    arg_parser.add_argument("--replay_api", type=str, default=None)
+    arg_parser.add_argument("--base_api", type=str, default=None)
+    arg_parser.add_argument("--router_api", type=str, default="fastchat")
+    arg_parser.add_argument("--endpoints", type=str, default=None)
+    arg_parser.add_argument(
+        "--route",
+        type=str,
+        default="least_outstanding",
+        choices=["least_outstanding", "latency"],
+    )
     arg_parser.add_argument(
         "--split",
         type=str,
@@ -32,6 +56,44 @@ if __name__ == "__main__":
     )
     arg_parser.add_argument("--temperature", type=float, default=0)
     arg_parser.add_argument("--max_tokens", type=int, default=512)
+    arg_parser.add_argument("--rpm", type=float, default=None)
+    arg_parser.add_argument("--tpm", type=float, default=None)
+    arg_parser.add_argument("--max_retries", type=int, default=8)
+    arg_parser.add_argument("--stream", action="store_true")
+    arg_parser.add_argument(
+        "--transport", type=str, default="sync", choices=["sync", "async"]
+    )
+    arg_parser.add_argument("--max_connections", type=int, default=100)
+    arg_parser.add_argument("--max_keepalive", type=int, default=20)
+    # replicate predictions are submitted and polled together, with at most
+    # max_inflight running; pipelined and async apis keep up to
+    # 2 * max(workers, max_inflight) or 2 * max(workers, max_connections)
+    # requests submitted, so --workers does not need raising for them
+    arg_parser.add_argument("--replicate_pipeline", action="store_true")
+    arg_parser.add_argument("--max_inflight", type=int, default=32)
+    arg_parser.add_argument("--deadline", type=float, default=600)
+    arg_parser.add_argument(
+        "--cache", type=str, default="file", choices=["file", "sqlite"]
+    )
+    arg_parser.add_argument("--cache_dir", type=str, default=None)
+    arg_parser.add_argument("--mock_latency", type=float, default=1.0)
+    arg_parser.add_argument(
+        "--mock_latency_dist",
+        type=str,
+        default="lognormal",
+        choices=["constant", "exponential", "lognormal"],
+    )
+    arg_parser.add_argument("--mock_error_rate", type=float, default=0.0)
+    arg_parser.add_argument("--mock_rpm", type=float, default=None)
+    arg_parser.add_argument("--workers", type=int, default=1)
+    arg_parser.add_argument("--resume", action="store_true")
+    arg_parser.add_argument("--flush_every", type=int, default=100)
+    arg_parser.add_argument("--shard", type=int, default=0)
+    arg_parser.add_argument("--num_shards", type=int, default=1)
+    arg_parser.add_argument(
+        "--dedup", type=str, default="none", choices=["none", "exact", "minhash"]
+    )
+    arg_parser.add_argument("--dedup_threshold", type=float, default=0.8)
 
     args = arg_parser.parse_args()
 
@@ -40,8 +102,6 @@ if __name__ == "__main__":
     )
     os.makedirs(artifacts_path, exist_ok=True)
 
-    data = read_jsonl(args.data_path)
-
     prompt_messages = read_jsonl(
         os.path.join(
             args.prompt_path, f"articulation-{args.split}-{args.method}-prompt.jsonl"
@@ -50,48 +110,88 @@ if __name__ == "__main__":
 
     api = build_api(args, artifacts_path)
 
-    responses = []
-    all_articulations = []
-    articulated_examples = []
-    annotations = []
-    for ex in tqdm(data):
-        text = format_text(ex["text"])
-        message = api.build_message(text)
-        messages = prompt_messages + [message]
-        response = api.send(messages)
-        responses.append(response)
-        articulations = extract_frames(response)
-        ex["articulations"] = articulations
-        articulated_examples.append(ex)
-        all_articulations.extend(articulations)
-        ann = {"id": ex["id"], "articulations": articulations}
-        annotations.append(ann)
-
-    seen = set()
-    dup_count = defaultdict(int)
-    unique_articulations = []
-    for f in all_articulations:
-        dup_count[f["text"]] += 1
-        if f["text"] in seen:
-            continue
-        seen.add(f["text"])
-        unique_articulations.append(f)
-    for frame in unique_articulations:
-        frame["count"] = dup_count[frame["text"]]
-
     pred_path = os.path.join(artifacts_path, "predictions")
+    if args.num_shards > 1:
+        # each shard writes its own files, merge.py combines them in data order
+        pred_path = os.path.join(pred_path, shard_name(args.shard, args.num_shards))
     os.makedirs(pred_path, exist_ok=True)
 
-    write_jsonl(all_articulations, os.path.join(pred_path, "articulations-full.jsonl"))
-    write_jsonl(
-        unique_articulations, os.path.join(pred_path, "articulations-unique.jsonl")
+    writer = ArticulationWriter(
+        pred_path, resume=args.resume, flush_every=args.flush_every
+    )
+    if args.resume:
+        print(f"Resuming after {writer.num_examples} articulated examples")
+
+    deduper = None
+    if args.dedup != "none":
+        # near-duplicate tweets are articulated once through their group's
+        # first tweet, every member still gets its own output lines and counts
+        deduper = build_deduper(args.dedup, args.dedup_threshold)
+
+    def build_requests():
+        for ex in iter_jsonl(args.data_path):
+            if args.num_shards > 1 and shard_of(ex["id"], args.num_shards) != args.shard:
+                continue
+            text = ex["text"]
+            if deduper is not None:
+                # assigned before skipping resumed ids so groups stay the same
+                text = deduper.assign(text)
+            if ex["id"] in writer.done_ids:
+                continue
+            text = format_text(text)
+            message = api.build_message(text)
+            yield ex, prompt_messages + [message]
+
+    missed_ids = []
+    pbar = tqdm(
+        send_all(
+            api,
+            build_requests(),
+            workers=args.workers,
+            # with --stream, generation is cut once the last frame is complete
+            stop_when=articulation_complete,
+        )
     )
-    write_jsonl(
-        articulated_examples, os.path.join(pred_path, "articulation-examples.jsonl")
+    for ex, response in pbar:
+        pbar.set_postfix(api.metrics.postfix(), refresh=False)
+        if response is None:
+            # not in the replayed cache, left for a later --resume run
+            missed_ids.append(ex["id"])
+            continue
+        articulations = extract_frames(response)
+        writer.write(ex, response, articulations)
+    writer.close()
+    api.metrics.dump(os.path.join(pred_path, "api-metrics.json"))
+    api.close()
+    if args.num_shards == 1:
+        # examples left by a replay are appended when a --resume run gets to
+        # them, so the files are rewritten in data order, with the counts a
+        # straight run gives; merge.py does the same for shards
+        rebuild_articulations(
+            [pred_path],
+            pred_path,
+            [
+                ex["id"]
+                for ex in iter_jsonl(args.data_path, fields=["id"])
+                if ex["id"] in writer.done_ids
+            ],
+        )
+
+    num_unique = write_unique_articulations(
+        writer.paths["full"], os.path.join(pred_path, "articulations-unique.jsonl")
     )
-    write_jsonl(annotations, os.path.join(pred_path, "articulation-annotations.jsonl"))
-    write_jsonl(responses, os.path.join(pred_path, "responses.jsonl"))
 
-    print(f"Articulated {len(articulated_examples)} examples")
-    print(f"Found {len(all_articulations)} frames")
-    print(f"Found {len(unique_articulations)} unique frames")
+    if deduper is not None:
+        print(
+            f"Collapsed {deduper.num_texts} tweets into {deduper.num_groups} "
+            f"near-duplicate groups"
+        )
+    if args.api == "replay":
+        write_jsonl(
+            [{"id": ex_id} for ex_id in missed_ids],
+            os.path.join(pred_path, "replay-misses.jsonl"),
+        )
+        print(f"Replay missed {len(missed_ids)} examples")
+    print(f"Articulated {writer.num_examples} examples")
+    print(f"Found {writer.num_frames} frames")
+    print(f"Found {num_unique} unique frames")
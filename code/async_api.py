@@ -0,0 +1,198 @@
+import asyncio
+import threading
+import time
+
+import httpx
+import ujson as json
+
+from api import (
+    OpenAIAPI,
+    DeepInfraAPI,
+    FastChatAPI,
+    StreamedCompletion,
+    EMPTY_ANSWER,
+    RequestRejected,
+)
+from ratelimit import is_retryable, is_config_error, retry_after, backoff_delay
+
+
+OPENAI_BASE_API = "https://api.openai.com/v1"
+
+
+class AsyncTransport:
+    # asyncio transport for the OpenAI-compatible backends: each instance has
+    # its own pooled keep-alive httpx client and event loop thread, and
+    # submit() schedules a request on that loop and returns a
+    # concurrent.futures.Future, so many requests share one thread
+    is_async = True
+
+    def init_transport(self, max_connections=100, max_keepalive=20, timeout=600):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=30,
+        )
+        # how many requests send_all keeps submitted
+        self.max_inflight = max_connections
+        self.timeout = httpx.Timeout(timeout, connect=10)
+        self.client = None
+        self.loop = None
+        self.loop_thread = None
+        self.loop_lock = threading.Lock()
+
+    def start_loop(self):
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.loop_thread = threading.Thread(
+                    target=self.loop.run_forever, daemon=True
+                )
+                self.loop_thread.start()
+        return self.loop
+
+    def get_client(self):
+        # created on the loop it is used from
+        if self.client is None:
+            headers = {}
+            if self.api_key is not None:
+                headers["Authorization"] = f"Bearer {self.api_key}"
+            self.client = httpx.AsyncClient(
+                base_url=(self.base_api or OPENAI_BASE_API).rstrip("/") + "/",
+                headers=headers,
+                limits=self.limits,
+                timeout=self.timeout,
+            )
+        return self.client
+
+    def submit(self, messages, stop_when=None):
+        return asyncio.run_coroutine_threadsafe(
+            self.send(messages, stop_when), self.start_loop()
+        )
+
+    async def send(self, messages, stop_when=None):
+        # cache reads and writes are blocking file or sqlite calls, so they
+        # run in the loop's default executor instead of stalling other requests
+        loop = asyncio.get_running_loop()
+        hash_key = self.cache_key(messages)
+        if self.cache is not None:
+            api_response = await loop.run_in_executor(
+                None, self.cached, messages, hash_key
+            )
+            if api_response is not None:
+                return self.process_response(api_response)
+        try:
+            api_response = await self.complete(messages, stop_when)
+        except RequestRejected:
+            return dict(EMPTY_ANSWER)
+        if self.cache is not None:
+            await loop.run_in_executor(None, self.store, hash_key, api_response)
+        return self.process_response(api_response)
+
+    async def complete(self, messages, stop_when=None):
+        tokens = self.estimate_tokens(messages)
+        attempt = 0
+        while True:
+            wait = self.rate_limiter.reserve(tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                self.metrics.record_sleep(wait)
+            start = time.perf_counter()
+            try:
+                response = await self.create(messages, stop_when)
+                self.metrics.record_call(
+                    time.perf_counter() - start, self.response_usage(response)
+                )
+                return response
+            except Exception as e:
+                if not is_retryable(e):
+                    self.metrics.record_failure(e)
+                    if is_config_error(e):
+                        print(f"{type(e).__name__}: {e} (not retryable)")
+                        raise
+                    print(f"{type(e).__name__}: {e} (skipping request)")
+                    raise RequestRejected(str(e)) from e
+                if attempt >= self.max_retries:
+                    self.metrics.record_failure(e)
+                    print(f"{type(e).__name__}: {e} (giving up after {attempt} retries)")
+                    raise
+                self.metrics.record_retry(e)
+                wait = retry_after(e)
+                delay = backoff_delay(
+                    attempt, self.backoff_seconds, retry_after_seconds=wait
+                )
+                if wait is not None:
+                    self.rate_limiter.pause(wait)
+                print(f"{type(e).__name__}: {e} (retrying in {delay:.0f}s)")
+                await asyncio.sleep(delay)
+                self.metrics.record_sleep(delay)
+                attempt += 1
+
+    async def create(self, messages, stop_when=None):
+        body = {
+            "model": self.api_model,
+            "messages": self.prepare_messages(messages),
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens,
+        }
+        client = self.get_client()
+        if not self.stream:
+            r = await client.post("chat/completions", json=body)
+            r.raise_for_status()
+            return r.json()
+        body["stream"] = True
+        completion = StreamedCompletion(self.api_model, stop_when)
+        # leaving the block early closes the connection instead of pooling it,
+        # which is what tells the server to stop generating
+        async with client.stream("POST", "chat/completions", json=body) as r:
+            if r.status_code >= 400:
+                await r.aread()
+                r.raise_for_status()
+            async for line in r.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:") :].strip()
+                if data == "[DONE]":
+                    break
+                if completion.add(json.loads(data)):
+                    break
+        return completion.response()
+
+    async def aclose(self):
+        # requests still running are cancelled and waited for, so none is left
+        # pending on a closed loop
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.loop.shutdown_asyncgens()
+        await self.loop.shutdown_default_executor()
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def close(self):
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self.aclose(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+            self.loop.close()
+            self.loop = None
+        super().close()
+
+
+class AsyncOpenAIAPI(AsyncTransport, OpenAIAPI):
+    def __init__(self, *args, max_connections=100, max_keepalive=20, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.init_transport(max_connections, max_keepalive)
+
+
+class AsyncDeepInfraAPI(AsyncTransport, DeepInfraAPI):
+    def __init__(self, *args, max_connections=100, max_keepalive=20, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.init_transport(max_connections, max_keepalive)
+
+
+class AsyncFastChatAPI(AsyncTransport, FastChatAPI):
+    def __init__(self, *args, max_connections=100, max_keepalive=20, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.init_transport(max_connections, max_keepalive)
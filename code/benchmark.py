@@ -0,0 +1,267 @@
+import argparse
+import os
+import pickle
+import random
+import shutil
+import subprocess
+import sys
+import time
+from hashlib import sha1
+
+import ujson as json
+
+import graph
+from mock_api import SUBJECTS, CLAIMS, CAUSES, mock_frame
+from utilities import write_jsonl, reduce_paraphrases, merge_relations
+
+
+CODE_PATH = os.path.dirname(os.path.abspath(__file__))
+FILLERS = ["", "Honestly, ", "Just saying: ", "RT @news: ", "Wow. ", "Thread: "]
+HASHTAGS = ["", " #covid19", " #vaccine", " #GetVaccinated", " #NoVaccineMandates"]
+
+
+def synthetic_tweets(num_tweets, seed=0, duplicate_rate=0.3):
+    # template tweets, with a share of retweets and copy-paste variants
+    rng = random.Random(seed)
+    tweets = []
+    for t_idx in range(num_tweets):
+        if tweets and rng.random() < duplicate_rate:
+            text = rng.choice(tweets)["text"]
+            text = rng.choice(FILLERS) + text + rng.choice(HASHTAGS)
+        else:
+            text = (
+                f"{rng.choice(FILLERS)}{rng.choice(SUBJECTS)} {rng.choice(CLAIMS)} "
+                f"since {rng.choice(CAUSES)} ({rng.randint(0, 10**6)})"
+                f"{rng.choice(HASHTAGS)} https://t.co/{rng.randint(0, 10**9)}"
+            )
+        tweets.append({"id": str(10**18 + t_idx), "text": text})
+    return tweets
+
+
+def synthetic_reference_frames(num_frames=200):
+    return {
+        f"F{f_idx}": {"text": mock_frame(f_idx * 7919)} for f_idx in range(num_frames)
+    }
+
+
+def synthetic_graph(num_frames, seed=0, relations_per_frame=1.5):
+    # frames with small paraphrase clusters, random specializes and
+    # contradicts edges, and some repeated edges and self-loops
+    rng = random.Random(seed)
+    frames = [
+        {"text": mock_frame(f_idx), "count": rng.choice([1, 1, 1, 2, 3])}
+        for f_idx in range(num_frames)
+    ]
+    relations = []
+    for _ in range(int(num_frames * relations_per_frame)):
+        rel_type = rng.choice(["paraphrases", "specializes", "contradicts"])
+        x = rng.randrange(num_frames)
+        if rel_type == "paraphrases":
+            y = min(num_frames - 1, x + rng.randint(0, 3))
+        else:
+            y = rng.randrange(num_frames)
+        relations.append(
+            {"type": rel_type, "x": x, "y": y, "reasoning": f"R{len(relations)}"}
+        )
+        if rng.random() < 0.05:
+            relations.append(dict(relations[-1], reasoning=f"R{len(relations)}"))
+    return frames, relations
+
+
+def run_graph(engine, num_frames, seed=0):
+    # one reduce and merge pass, printing a digest of everything they return
+    frames, relations = synthetic_graph(num_frames, seed)
+    if engine == "array":
+        reduce_fn, merge_fn = graph.reduce_paraphrases, graph.merge_relations
+    elif engine == "networkx":
+        reduce_fn, merge_fn = reduce_paraphrases, merge_relations
+    else:
+        raise ValueError(f"Unknown graph engine: {engine}")
+    start = time.perf_counter()
+    reduced_frames, reduced_relations, kept_nodes, reduced_count = reduce_fn(
+        frames, relations
+    )
+    merged_frames, merged_relations, merged_nodes, merged_count = merge_fn(
+        frames, reduced_relations, kept_nodes, reduced_count
+    )
+    print(f"{engine}: {time.perf_counter() - start:.2f}s")
+    outputs = [
+        list(reduced_frames),
+        reduced_relations,
+        list(kept_nodes),
+        list(reduced_count.items()),
+        list(merged_frames),
+        merged_relations,
+        list(merged_nodes),
+        list(merged_count.items()),
+    ]
+    print(sha1(pickle.dumps(outputs)).hexdigest())
+
+
+def run_stage(name, command):
+    # each stage in its own process, so peak RSS is measured per stage
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+    )
+    output = process.stdout.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    status = os.waitstatus_to_exitcode(status)
+    if status != 0:
+        print(output)
+        raise RuntimeError(f"{name} failed with status {status}")
+    return {
+        "stage": name,
+        "wall_seconds": wall,
+        # ru_maxrss is in kilobytes on linux
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+    }, output
+
+
+def count_lines(path):
+    with open(path, "r") as f:
+        return sum(1 for _ in f)
+
+
+def count_calls(path):
+    # completed provider calls, counting re-issued speculative requests and
+    # leaving out cache hits and requests shared while in flight, neither of
+    # which the lines of responses.jsonl tell apart
+    with open(path, "r") as f:
+        return json.load(f)["calls"]
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--scales", type=str, default="1000,10000,100000")
+    arg_parser.add_argument("--stages", type=str, default="articulate,relations,relevance")
+    arg_parser.add_argument("--bench_path", type=str, default="/tmp/co-vax-frames-bench")
+    arg_parser.add_argument("--output", type=str, default=None)
+    arg_parser.add_argument("--workers", type=int, default=16)
+    arg_parser.add_argument("--mock_latency", type=float, default=0.05)
+    arg_parser.add_argument("--mock_latency_dist", type=str, default="lognormal")
+    arg_parser.add_argument("--mock_error_rate", type=float, default=0.0)
+    arg_parser.add_argument("--mock_rpm", type=float, default=None)
+    arg_parser.add_argument("--extra_args", type=str, default="")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    # runs a single graph stage engine, used by the graph stage
+    arg_parser.add_argument("--graph_engine", type=str, default=None)
+
+    args = arg_parser.parse_args()
+    if args.graph_engine is not None:
+        for scale in [int(s) for s in args.scales.split(",")]:
+            run_graph(args.graph_engine, scale, args.seed)
+        sys.exit(0)
+    stages = args.stages.split(",")
+    prompt_path = os.path.join(os.path.dirname(CODE_PATH), "annotations")
+    mock_args = [
+        "--api",
+        "mock",
+        "--model",
+        "mock",
+        "--method",
+        "few",
+        "--mock_latency",
+        str(args.mock_latency),
+        "--mock_latency_dist",
+        args.mock_latency_dist,
+        "--mock_error_rate",
+        str(args.mock_error_rate),
+    ]
+    if args.mock_rpm is not None:
+        mock_args += ["--mock_rpm", str(args.mock_rpm)]
+
+    results = []
+    for scale in [int(s) for s in args.scales.split(",")]:
+        scale_path = os.path.join(args.bench_path, str(scale))
+        if os.path.exists(scale_path):
+            shutil.rmtree(scale_path)
+        os.makedirs(scale_path)
+        data_path = os.path.join(scale_path, "tweets.jsonl")
+        write_jsonl(synthetic_tweets(scale, args.seed), data_path)
+        ref_path = os.path.join(scale_path, "reference-frames.json")
+        with open(ref_path, "w") as f:
+            json.dump(synthetic_reference_frames(), f)
+        run_path = os.path.join(scale_path, "mock-few-test")
+        common = ["--art_path", scale_path] + args.extra_args.split()
+
+        if "articulate" in stages:
+            result, _ = run_stage(
+                "articulate",
+                [sys.executable, os.path.join(CODE_PATH, "articulate.py")]
+                + mock_args
+                + common
+                + ["--prompt_path", prompt_path, "--data_path", data_path]
+                + ["--workers", str(args.workers)],
+            )
+            result["calls"] = count_calls(
+                os.path.join(run_path, "articulations", "predictions", "api-metrics.json")
+            )
+            result["frames"] = count_lines(
+                os.path.join(
+                    run_path, "articulations", "predictions", "articulations-unique.jsonl"
+                )
+            )
+            results.append({"scale": scale, **result})
+        if "relations" in stages:
+            result, _ = run_stage(
+                "relations",
+                [sys.executable, os.path.join(CODE_PATH, "relations.py")]
+                + mock_args
+                + common
+                + ["--prompt_path", prompt_path, "--similarity", "hashing"]
+                + ["--workers", str(args.workers)],
+            )
+            result["calls"] = count_calls(
+                os.path.join(run_path, "relations", "predictions", "api-metrics.json")
+            )
+            results.append({"scale": scale, **result})
+        if "relevance" in stages:
+            result, _ = run_stage(
+                "relevance",
+                [sys.executable, os.path.join(CODE_PATH, "relevance.py")]
+                + ["--model", "mock", "--method", "few", "--similarity", "hashing"]
+                + common
+                + ["--data_path", ref_path],
+            )
+            result["calls"] = 0
+            results.append({"scale": scale, **result})
+        if "graph" in stages:
+            # relevance graph reduction on a synthetic graph with one frame per
+            # tweet, networkx against the array engine
+            digests = {}
+            for engine in ["networkx", "array"]:
+                result, output = run_stage(
+                    f"graph-{engine}",
+                    [sys.executable, os.path.join(CODE_PATH, "benchmark.py")]
+                    + ["--graph_engine", engine, "--scales", str(scale)]
+                    + ["--seed", str(args.seed)],
+                )
+                timing, digests[engine] = output.split("\n")[-3:-1]
+                result["engine_seconds"] = float(timing.split()[-1].rstrip("s"))
+                result["calls"] = 0
+                results.append({"scale": scale, **result})
+            if digests["networkx"] != digests["array"]:
+                raise RuntimeError(f"Graph engines disagree at scale {scale}")
+            networkx_seconds, array_seconds = [
+                r["engine_seconds"] for r in results[-2:]
+            ]
+            print(
+                f"{scale:>8} graph: networkx {networkx_seconds:.2f}s, "
+                f"array {array_seconds:.2f}s "
+                f"({networkx_seconds / max(array_seconds, 1e-9):.1f}x)"
+            )
+        for result in results:
+            if result["scale"] == scale:
+                result["calls_per_second"] = result["calls"] / result["wall_seconds"]
+                print(
+                    f'{scale:>8} {result["stage"]:<12} '
+                    f'{result["wall_seconds"]:8.1f}s '
+                    f'{result["peak_rss_mb"]:8.0f}MB '
+                    f'{result["calls_per_second"]:8.1f} calls/s'
+                )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,269 @@
+from abc import ABC, abstractmethod
+import argparse
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import ujson as json
+
+
+class ResponseCache(ABC):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    @abstractmethod
+    def load(self, key):
+        pass
+
+    @abstractmethod
+    def put(self, key, value):
+        pass
+
+    def get(self, key):
+        value = self.load(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+        }
+
+    def close(self):
+        pass
+
+
+class FileCache(ResponseCache):
+    # one <key>.json file per response, the original layout
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def load(self, key):
+        cache_file = os.path.join(self.path, f"{key}.json")
+        if not os.path.exists(cache_file):
+            return None
+        with open(cache_file, "r") as f:
+            return json.load(f)
+
+    def put(self, key, value):
+        cache_file = os.path.join(self.path, f"{key}.json")
+        # write then rename so concurrent senders never read a partial file
+        tmp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp_file, cache_file)
+        self.writes += 1
+
+
+class SQLiteCache(ResponseCache):
+    # single indexed file with zlib-compressed json values; it keeps sqlite's
+    # default rollback journal, since WAL needs shared memory that network
+    # filesystems such as a --cache_dir on /shared do not provide
+    def __init__(self, path, batch_size=500):
+        super().__init__()
+        self.path = path
+        self.batch_size = batch_size
+        cache_dir = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=60)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, created REAL NOT NULL)"
+        )
+        # hits, misses and writes summed over every run that closed the cache
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS counters ("
+            "name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+        self.conn.commit()
+        self.closed = False
+
+    @staticmethod
+    def encode(value):
+        return zlib.compress(json.dumps(value).encode(), 6)
+
+    @staticmethod
+    def decode(data):
+        return json.loads(zlib.decompress(data).decode())
+
+    def load(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return self.decode(row[0])
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        rows = [(key, self.encode(value), time.time()) for key, value in items]
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO responses (key, value, created) VALUES (?, ?, ?)",
+                rows,
+            )
+            self.conn.commit()
+        self.writes += len(rows)
+
+    def summary(self):
+        with self.lock:
+            count, size = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM responses"
+            ).fetchone()
+            counters = dict(
+                self.conn.execute("SELECT name, value FROM counters").fetchall()
+            )
+        hits = counters.get("hits", 0)
+        misses = counters.get("misses", 0)
+        return {
+            "entries": count,
+            "compressed_bytes": size,
+            "file_bytes": os.path.getsize(self.path),
+            "hits": hits,
+            "misses": misses,
+            "writes": counters.get("writes", 0),
+            "hit_rate": hits / (hits + misses) if hits + misses > 0 else 0.0,
+        }
+
+    def prune(self, max_age_days=None, max_entries=None):
+        removed = 0
+        with self.lock:
+            if max_age_days is not None:
+                cutoff = time.time() - max_age_days * 24 * 60 * 60
+                removed += self.conn.execute(
+                    "DELETE FROM responses WHERE created < ?", (cutoff,)
+                ).rowcount
+            if max_entries is not None:
+                removed += self.conn.execute(
+                    "DELETE FROM responses WHERE key NOT IN "
+                    "(SELECT key FROM responses ORDER BY created DESC LIMIT ?)",
+                    (max_entries,),
+                ).rowcount
+            self.conn.commit()
+        return removed
+
+    def compact(self):
+        with self.lock:
+            self.conn.execute("VACUUM")
+
+    def migrate(self, cache_dir):
+        # imports an old FileCache directory, keeping entries already present;
+        # its files are named by the legacy key, which cannot be turned into
+        # the current one without the messages, so they are only found through
+        # the legacy lookup and belong in a run's <backend>-cache.db
+        imported = 0
+        errors = 0
+        batch = []
+        for entry in os.scandir(cache_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path, "r") as f:
+                    value = json.load(f)
+            except Exception:
+                errors += 1
+                continue
+            key = entry.name[: -len(".json")]
+            batch.append((key, self.encode(value), entry.stat().st_mtime))
+            if len(batch) >= self.batch_size:
+                imported += self.insert_missing(batch)
+                batch = []
+        if batch:
+            imported += self.insert_missing(batch)
+        return imported, errors
+
+    def insert_missing(self, rows):
+        with self.lock:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO responses (key, value, created) VALUES (?, ?, ?)",
+                rows,
+            )
+            self.conn.commit()
+            return self.conn.total_changes - before
+
+    def close(self):
+        # adds this run's counters to the totals, so a run killed before
+        # closing leaves them out
+        with self.lock:
+            if self.closed:
+                return
+            self.conn.executemany(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                [("hits", self.hits), ("misses", self.misses), ("writes", self.writes)],
+            )
+            self.conn.commit()
+            self.conn.close()
+            self.closed = True
+
+
+def build_cache(kind, path):
+    if kind == "file":
+        return FileCache(path)
+    elif kind == "sqlite":
+        return SQLiteCache(path)
+    else:
+        raise ValueError(f"Unknown cache: {kind}")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    sub_parsers = arg_parser.add_subparsers(dest="command", required=True)
+    stats_parser = sub_parsers.add_parser(
+        "stats", help="entries, size, and hits and misses of the runs that closed it"
+    )
+    stats_parser.add_argument("path", type=str)
+    prune_parser = sub_parsers.add_parser("prune")
+    prune_parser.add_argument("path", type=str)
+    prune_parser.add_argument("--max_age_days", type=float, default=None)
+    prune_parser.add_argument("--max_entries", type=int, default=None)
+    compact_parser = sub_parsers.add_parser("compact")
+    compact_parser.add_argument("path", type=str)
+    migrate_parser = sub_parsers.add_parser("migrate")
+    migrate_parser.add_argument(
+        "path", type=str, help="the run's <artifacts>/<backend>-cache.db"
+    )
+    migrate_parser.add_argument("cache_dirs", type=str, nargs="+")
+
+    args = arg_parser.parse_args()
+    if args.command == "migrate" and not args.path.endswith("-cache.db"):
+        # a shared --cache_dir database is never read with legacy keys
+        arg_parser.error(
+            "migrate imports legacy keys, the target must be a run's "
+            "<backend>-cache.db, which build_response_cache reads as the "
+            "legacy cache"
+        )
+
+    cache = SQLiteCache(args.path)
+    if args.command == "stats":
+        print(json.dumps(cache.summary(), indent=2))
+    elif args.command == "prune":
+        removed = cache.prune(args.max_age_days, args.max_entries)
+        print(f"Removed {removed} entries")
+    elif args.command == "compact":
+        before = os.path.getsize(args.path)
+        cache.compact()
+        print(f"Compacted {before} -> {os.path.getsize(args.path)} bytes")
+    elif args.command == "migrate":
+        for cache_dir in args.cache_dirs:
+            imported, errors = cache.migrate(cache_dir)
+            print(f"Imported {imported} entries from {cache_dir} ({errors} unreadable)")
+    cache.close()
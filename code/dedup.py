@@ -0,0 +1,106 @@
+import re
+from zlib import crc32
+
+import numpy as np
+
+from utilities import format_text
+
+
+# 2^31 - 1, so a * h + b stays below 2^63 and uint64 math never overflows
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def normalize_text(text):
+    # retweet prefixes, urls, mentions, case and punctuation do not change
+    # what a tweet says, so they do not separate near-duplicates
+    text = format_text(text).lower()
+    text = re.sub(r"^rt @user:?", "", text)
+    text = re.sub(r"@user", "", text)
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+class ExactDeduper:
+    def __init__(self):
+        self.reps = {}
+        self.num_texts = 0
+
+    def assign(self, text):
+        # returns the text of the first tweet with the same normalized text
+        self.num_texts += 1
+        key = normalize_text(text)
+        if key not in self.reps:
+            self.reps[key] = text
+        return self.reps[key]
+
+    @property
+    def num_groups(self):
+        return len(self.reps)
+
+
+class MinHashDeduper:
+    # online MinHash/LSH grouping: each tweet joins the earliest representative
+    # whose estimated Jaccard similarity over word shingles meets the threshold,
+    # otherwise it becomes a new representative
+    def __init__(self, threshold=0.8, num_perm=64, bands=16, shingle_size=3, seed=0):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = []
+        self.texts = []
+        self.num_texts = 0
+
+    def shingles(self, text):
+        words = normalize_text(text).split()
+        if len(words) < self.shingle_size:
+            return {" ".join(words)}
+        return {
+            " ".join(words[i : i + self.shingle_size])
+            for i in range(len(words) - self.shingle_size + 1)
+        }
+
+    def signature(self, text):
+        hashes = np.array(
+            [crc32(s.encode()) % MERSENNE_PRIME for s in self.shingles(text)],
+            dtype=np.uint64,
+        )
+        return ((hashes[:, None] * self.a + self.b) % MERSENNE_PRIME).min(axis=0)
+
+    def assign(self, text):
+        self.num_texts += 1
+        sig = self.signature(text)
+        band_keys = [
+            sig[i * self.rows : (i + 1) * self.rows].tobytes()
+            for i in range(self.bands)
+        ]
+        candidates = set()
+        for bucket, key in zip(self.buckets, band_keys):
+            candidates.update(bucket.get(key, []))
+        for rep in sorted(candidates):
+            if np.mean(self.signatures[rep] == sig) >= self.threshold:
+                return self.texts[rep]
+        rep = len(self.texts)
+        self.signatures.append(sig)
+        self.texts.append(text)
+        for bucket, key in zip(self.buckets, band_keys):
+            bucket.setdefault(key, []).append(rep)
+        return text
+
+    @property
+    def num_groups(self):
+        return len(self.texts)
+
+
+def build_deduper(kind, threshold=0.8):
+    if kind == "exact":
+        return ExactDeduper()
+    elif kind == "minhash":
+        return MinHashDeduper(threshold=threshold)
+    else:
+        raise ValueError(f"Unknown dedup: {kind}")
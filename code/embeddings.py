@@ -0,0 +1,135 @@
+import fcntl
+import os
+import re
+from contextlib import contextmanager
+from hashlib import sha1
+
+import numpy as np
+
+
+class EmbeddingStore:
+    # on-disk embeddings keyed by (model name, text hash): a float32 matrix that
+    # is memory-mapped for reads plus an index file with one text hash per row,
+    # so only texts never seen before are sent through the model
+    def __init__(self, path, model_name, load_model):
+        self.path = path
+        self.model_name = model_name
+        self.load_model = load_model
+        self.model = None
+        os.makedirs(self.path, exist_ok=True)
+        name = model_name.replace("/", "--")
+        self.matrix_path = os.path.join(self.path, f"{name}.f32")
+        self.index_path = os.path.join(self.path, f"{name}.index")
+        # the embedding size, written with the first rows
+        self.dim_path = os.path.join(self.path, f"{name}.dim")
+        self.lock_path = os.path.join(self.path, f"{name}.lock")
+        self.rows = {}
+        self.dim = None
+        self.matrix = None
+        self.load_index()
+
+    @staticmethod
+    def text_hash(text):
+        return sha1(text.encode()).hexdigest()
+
+    @contextmanager
+    def locked(self):
+        # several runs may share one store, so appends are serialised
+        with open(self.lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load_index(self, repair=False):
+        # with repair, which needs the lock, whatever an interrupted append
+        # left behind its last complete row is cut off both files
+        self.rows = {}
+        index_bytes = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        # partially written row from an interrupted append
+                        break
+                    self.rows[line[:-1]] = len(self.rows)
+                    index_bytes += len(line)
+            if repair and os.path.getsize(self.index_path) > index_bytes:
+                os.truncate(self.index_path, index_bytes)
+        self.dim = None
+        if os.path.exists(self.dim_path):
+            with open(self.dim_path, "r") as f:
+                self.dim = int(f.read())
+        elif len(self.rows) > 0:
+            raise ValueError(
+                f"{self.dim_path} is missing, the embedding size of "
+                f"{self.matrix_path} is unknown; delete the store to rebuild it"
+            )
+        self.matrix = None
+        if len(self.rows) > 0:
+            num_bytes = len(self.rows) * self.dim * 4
+            if repair and os.path.getsize(self.matrix_path) > num_bytes:
+                os.truncate(self.matrix_path, num_bytes)
+            self.matrix = np.memmap(
+                self.matrix_path,
+                dtype=np.float32,
+                mode="r",
+                shape=(len(self.rows), self.dim),
+            )
+
+    def append(self, hashes, embs):
+        if self.dim is None:
+            self.dim = embs.shape[1]
+            with open(self.dim_path + ".tmp", "w") as f:
+                f.write(str(self.dim))
+            os.replace(self.dim_path + ".tmp", self.dim_path)
+        with open(self.matrix_path, "ab") as f:
+            f.write(np.ascontiguousarray(embs, dtype=np.float32).tobytes())
+        with open(self.index_path, "a") as f:
+            f.write("".join(h + "\n" for h in hashes))
+
+    def encode(self, texts, show_progress_bar=False, **kwargs):
+        hashes = [self.text_hash(t) for t in texts]
+        missing = {}
+        for h, t in zip(hashes, texts):
+            if h not in self.rows and h not in missing:
+                missing[h] = t
+        if len(missing) > 0:
+            with self.locked():
+                self.load_index(repair=True)
+                missing = {h: t for h, t in missing.items() if h not in self.rows}
+                if len(missing) > 0:
+                    if self.model is None:
+                        self.model = self.load_model(self.model_name)
+                    embs = self.model.encode(
+                        list(missing.values()),
+                        show_progress_bar=show_progress_bar,
+                        **kwargs,
+                    )
+                    self.append(list(missing.keys()), np.asarray(embs))
+                    self.load_index()
+        if len(texts) == 0:
+            return np.zeros(shape=[0, self.dim or 0], dtype=np.float32)
+        rows = np.array([self.rows[h] for h in hashes], dtype=np.int64)
+        if rows[-1] - rows[0] == len(rows) - 1 and np.all(np.diff(rows) == 1):
+            # same texts in the same order as stored, return a zero-copy view
+            return self.matrix[rows[0] : rows[-1] + 1]
+        return np.asarray(self.matrix[rows])
+
+
+class HashingEncoder:
+    # deterministic bag-of-words embeddings for offline runs and benchmarks,
+    # with the same interface as SentenceTransformer.encode
+    def __init__(self, model_name, dim=384):
+        self.model_name = model_name
+        self.dim = dim
+
+    def encode(self, texts, show_progress_bar=False, **kwargs):
+        embs = np.zeros(shape=[len(texts), self.dim], dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                h = int(sha1(word.encode()).hexdigest()[:8], 16)
+                embs[i, h % self.dim] += 1.0 if (h >> 16) % 2 == 0 else -1.0
+        norms = np.linalg.norm(embs, axis=-1, keepdims=True)
+        return embs / np.maximum(norms, 1e-8)
@@ -0,0 +1,258 @@
+from collections import defaultdict
+
+import numpy as np
+
+
+# array-backed versions of reduce_paraphrases and merge_relations from
+# utilities, over integer frame ids with union-find components and CSR
+# adjacency; outputs match the networkx versions exactly, including the
+# order of dict keys and relations and which node of a component is kept
+
+
+class UnionFind:
+    def __init__(self, num_nodes):
+        self.parent = list(range(num_nodes))
+        self.size = [1] * num_nodes
+
+    def find(self, n):
+        parent = self.parent
+        while parent[n] != n:
+            parent[n] = parent[parent[n]]
+            n = parent[n]
+        return n
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+
+    def roots(self):
+        parent = np.array(self.parent, dtype=np.int64)
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                return parent
+            parent = grandparent
+
+
+class CSR:
+    # adjacency lists of src -> dst, each list in the order the pairs are given
+    def __init__(self, src, dst, num_nodes, data=None):
+        order = np.argsort(src, kind="stable")
+        self.indptr = np.zeros(shape=[num_nodes + 1], dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=num_nodes), out=self.indptr[1:])
+        self.indices = dst[order]
+        self.data = None if data is None else data[order]
+
+
+def first_occurrences(keys):
+    # positions of the first occurrence of each distinct key, in input order
+    _, index = np.unique(keys, return_index=True)
+    return np.sort(index)
+
+
+def last_occurrences(keys):
+    # distinct keys, sorted, with the position of the last occurrence of each
+    unique, index = np.unique(keys[::-1], return_index=True)
+    return unique, len(keys) - 1 - index
+
+
+def lookup(unique, keys):
+    # position of each key in the sorted unique keys, -1 when missing
+    pos = np.searchsorted(unique, keys)
+    pos[pos == len(unique)] = 0
+    if len(unique) == 0:
+        return np.full(shape=keys.shape, fill_value=-1, dtype=np.int64)
+    return np.where(unique[pos] == keys, pos, -1)
+
+
+def undirected_adjacency(x, y, num_nodes):
+    # neighbours in the order nx.Graph keeps them: a neighbour is placed when
+    # the first edge between the two nodes is added, in either direction
+    src = np.stack([x, y], axis=1).reshape(-1)
+    dst = np.stack([y, x], axis=1).reshape(-1)
+    first = first_occurrences(src * num_nodes + dst)
+    return CSR(src[first], dst[first], num_nodes)
+
+
+RELATION_TYPES = {"paraphrases": 0, "specializes": 1, "contradicts": 2}
+
+
+def relation_arrays(relations):
+    # type code, x and y of every relation
+    types = np.array(
+        [RELATION_TYPES.get(r["type"], -1) for r in relations], dtype=np.int64
+    )
+    x = np.array([r["x"] for r in relations], dtype=np.int64)
+    y = np.array([r["y"] for r in relations], dtype=np.int64)
+    return types, x, y
+
+
+def component_set(source, indptr, indices):
+    # the same set nx.connected_components builds for this component, so that
+    # iterating it visits nodes in the same order
+    seen = {source}
+    nextlevel = [source]
+    while nextlevel:
+        thislevel = nextlevel
+        nextlevel = []
+        for v in thislevel:
+            for w in indices[indptr[v] : indptr[v + 1]]:
+                if w not in seen:
+                    seen.add(w)
+                    nextlevel.append(w)
+    return seen
+
+
+def reduce_paraphrases(frames, relations):
+    num_frames = len(frames)
+    types, x, y = relation_arrays(relations)
+    paraphrases = types == RELATION_TYPES["paraphrases"]
+    x = x[paraphrases]
+    y = y[paraphrases]
+
+    components = UnionFind(num_frames)
+    for a, b in zip(x.tolist(), y.tolist()):
+        components.union(a, b)
+    roots = components.roots()
+
+    # networkx degree: distinct neighbours, with a self-loop counting twice
+    pairs = np.unique(np.minimum(x, y) * num_frames + np.maximum(x, y))
+    degree = np.bincount(pairs // num_frames, minlength=num_frames) + np.bincount(
+        pairs % num_frames, minlength=num_frames
+    )
+    max_degree = np.zeros(shape=[num_frames], dtype=np.int64)
+    np.maximum.at(max_degree, roots, degree)
+    is_max = degree == max_degree[roots]
+    num_max = np.bincount(roots[is_max], minlength=num_frames)
+
+    # a component's kept node is its first node of max degree in set order,
+    # which only needs the set rebuilt when several nodes share the max
+    kept_of_root = np.full(shape=[num_frames], fill_value=-1, dtype=np.int64)
+    single = is_max & (num_max[roots] == 1)
+    kept_of_root[roots[single]] = np.nonzero(single)[0]
+    comp_roots, comp_first = np.unique(roots, return_index=True)
+    tied = num_max[comp_roots] > 1
+    if tied.any():
+        adj = undirected_adjacency(x, y, num_frames)
+        indptr = adj.indptr.tolist()
+        indices = adj.indices.tolist()
+        degree_list = degree.tolist()
+        for root, source in zip(comp_roots[tied].tolist(), comp_first[tied].tolist()):
+            max_node = None
+            max_deg = -1
+            for n in component_set(source, indptr, indices):
+                d = degree_list[n]
+                if d > max_deg:
+                    max_deg = d
+                    max_node = n
+            kept_of_root[root] = max_node
+    node_map = kept_of_root[roots]
+
+    counts = np.array([f["count"] for f in frames], dtype=np.int64)
+    total = np.zeros(shape=[num_frames], dtype=np.int64)
+    np.add.at(total, node_map, counts)
+    # components are visited in the order of their first node
+    kept_list = kept_of_root[comp_roots[np.argsort(comp_first)]].tolist()
+    kept_nodes = set(kept_list)
+    reduced_count = defaultdict(int, zip(kept_list, total[kept_list].tolist()))
+
+    node_map = node_map.tolist()
+    reduced_relations = []
+    for edge in relations:
+        if edge["type"] != "paraphrases":
+            reduced_relations.append(
+                {
+                    "type": edge["type"],
+                    "x": node_map[edge["x"]],
+                    "y": node_map[edge["y"]],
+                    "reasoning": edge["reasoning"],
+                }
+            )
+
+    reduced_frames = {f_idx: frames[f_idx] for f_idx in sorted(kept_list)}
+    return reduced_frames, reduced_relations, kept_nodes, reduced_count
+
+
+def merge_relations(frames, reduced_relations, kept_nodes, reduced_count):
+    min_count = 2
+    num_frames = len(frames)
+    kept = np.zeros(shape=[num_frames], dtype=bool)
+    kept_sorted = sorted(kept_nodes)
+    kept[kept_sorted] = True
+
+    # specializes edges as a DiGraph: out and in lists in first-insertion
+    # order, each edge carrying the reasoning of its last occurrence
+    types, rx, ry = relation_arrays(reduced_relations)
+    both_kept = kept[rx] & kept[ry]
+    s_rel = np.nonzero((types == RELATION_TYPES["specializes"]) & both_kept)[0]
+    sx = rx[s_rel]
+    sy = ry[s_rel]
+    s_keys = sx * num_frames + sy
+    first = first_occurrences(s_keys)
+    s_unique, s_last = last_occurrences(s_keys)
+    s_reasoning = s_rel[s_last[lookup(s_unique, s_keys[first])]]
+    out_adj = CSR(sx[first], sy[first], num_frames, s_reasoning)
+    in_adj = CSR(sy[first], sx[first], num_frames)
+
+    # contradicts edges as a Graph, reasoning looked up in either direction
+    c_rel = np.nonzero((types == RELATION_TYPES["contradicts"]) & both_kept)[0]
+    cx = rx[c_rel]
+    cy = ry[c_rel]
+    c_unique, c_last = last_occurrences(cx * num_frames + cy)
+    c_adj = undirected_adjacency(cx, cy, num_frames)
+    c_src = np.repeat(np.arange(num_frames), np.diff(c_adj.indptr))
+    pos = lookup(c_unique, c_src * num_frames + c_adj.indices)
+    reverse = lookup(c_unique, c_adj.indices * num_frames + c_src)
+    c_reasoning = c_rel[c_last[np.where(pos != -1, pos, reverse)]]
+
+    out_ptr = out_adj.indptr.tolist()
+    out_nodes = out_adj.indices.tolist()
+    out_reasoning = out_adj.data.tolist()
+    in_ptr = in_adj.indptr.tolist()
+    in_nodes = in_adj.indices.tolist()
+    c_ptr = c_adj.indptr.tolist()
+    c_nodes = c_adj.indices.tolist()
+    c_reasoning = c_reasoning.tolist()
+
+    merged_count = reduced_count.copy()
+    merged = set()
+    # relations added by merging, as (type, x, y, relation holding the reasoning)
+    added = []
+    for n in kept_sorted:
+        count = reduced_count[n]
+        if count >= min_count:
+            continue
+        merged.add(n)
+        for o_idx in range(out_ptr[n], out_ptr[n + 1]):
+            v = out_nodes[o_idx]
+            for c_idx in range(c_ptr[n], c_ptr[n + 1]):
+                added.append(("contradicts", c_nodes[c_idx], v, c_reasoning[c_idx]))
+            merged_count[v] += count
+            for i_idx in range(in_ptr[n], in_ptr[n + 1]):
+                added.append(("specializes", in_nodes[i_idx], v, out_reasoning[o_idx]))
+
+    is_merged = np.zeros(shape=[num_frames], dtype=bool)
+    is_merged[list(merged)] = True
+    keep = ~(is_merged[rx] | is_merged[ry])
+    merged_relations = [reduced_relations[idx] for idx in np.nonzero(keep)[0].tolist()]
+    for rel_type, u, v, r_idx in added:
+        if u not in merged and v not in merged:
+            merged_relations.append(
+                {
+                    "type": rel_type,
+                    "x": u,
+                    "y": v,
+                    "reasoning": reduced_relations[r_idx]["reasoning"],
+                }
+            )
+
+    merged_frames = {
+        f_idx: frames[f_idx] for f_idx in kept_sorted if f_idx not in merged
+    }
+    return merged_frames, merged_relations, merged, merged_count
@@ -0,0 +1,122 @@
+import numpy as np
+
+
+class ActiveIndex:
+    # exact nearest-neighbour search over the currently active frames, keeping
+    # their embeddings packed so each query is a chunked scan of active rows only
+    def __init__(self, embeddings, chunk_size=16384):
+        self.embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.chunk_size = chunk_size
+        num_frames, dim = self.embeddings.shape
+        self.mask = np.zeros(shape=[num_frames], dtype=np.float32)
+        self.ids = np.zeros(shape=[num_frames], dtype=np.int64)
+        self.position = np.full(shape=[num_frames], fill_value=-1, dtype=np.int64)
+        self.vectors = np.zeros(shape=[num_frames, dim], dtype=np.float32)
+        self.size = 0
+        # bumped on every change to the active set
+        self.version = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, f_idx):
+        return self.position[f_idx] != -1
+
+    def add(self, f_idx):
+        if f_idx in self:
+            return
+        self.ids[self.size] = f_idx
+        self.vectors[self.size] = self.embeddings[f_idx]
+        self.position[f_idx] = self.size
+        self.mask[f_idx] = 1.0
+        self.size += 1
+        self.version += 1
+
+    def remove(self, f_idx):
+        if f_idx not in self:
+            return
+        pos = self.position[f_idx]
+        last = self.size - 1
+        if pos != last:
+            # swap the last active frame into the freed slot
+            moved = self.ids[last]
+            self.ids[pos] = moved
+            self.vectors[pos] = self.vectors[last]
+            self.position[moved] = pos
+        self.position[f_idx] = -1
+        self.mask[f_idx] = 0.0
+        self.size -= 1
+        self.version += 1
+
+    def search(self, f_idx, k):
+        # active frames ordered by (squared distance, frame id), at most k
+        query = self.embeddings[f_idx]
+        best_ids = np.zeros(shape=[0], dtype=np.int64)
+        best_dists = np.zeros(shape=[0], dtype=np.float32)
+        for start in range(0, self.size, self.chunk_size):
+            end = min(start + self.chunk_size, self.size)
+            dists = np.sum((self.vectors[start:end] - query) ** 2, axis=-1)
+            ids = self.ids[start:end]
+            if len(dists) > k:
+                top = np.argpartition(dists, k - 1)[:k]
+                # keep every frame tied with the k-th distance so ties resolve by id
+                top = np.flatnonzero(dists <= dists[top].max())
+                dists = dists[top]
+                ids = ids[top]
+            best_ids = np.concatenate([best_ids, ids])
+            best_dists = np.concatenate([best_dists, dists])
+        order = np.lexsort((best_ids, best_dists))[:k]
+        return best_ids[order], best_dists[order]
+
+
+def top_k_matches(queries, references, k=1, max_elements=2**24, margin=8):
+    # exact k nearest references of every query by squared distance, ties by
+    # reference index like np.argmin; queries are scanned in chunks whose
+    # distance matrix holds at most max_elements floats, candidates are picked
+    # with one matrix product per chunk and then re-scored exactly
+    queries = np.asarray(queries, dtype=np.float32)
+    references = np.asarray(references, dtype=np.float32)
+    num_queries = len(queries)
+    num_refs = len(references)
+    k = min(k, num_refs)
+    ids = np.zeros(shape=[num_queries, k], dtype=np.int64)
+    dists = np.zeros(shape=[num_queries, k], dtype=np.float32)
+    if k == 0:
+        return ids, dists
+    num_candidates = min(k + margin, num_refs)
+    r_sq = np.sum(references**2, axis=-1)
+    chunk_size = max(1, max_elements // num_refs)
+    for start in range(0, num_queries, chunk_size):
+        end = min(start + chunk_size, num_queries)
+        chunk = queries[start:end]
+        approx = np.sum(chunk**2, axis=-1)[:, None] + r_sq[None, :]
+        approx -= 2 * (chunk @ references.T)
+        if num_candidates < num_refs:
+            candidates = np.argpartition(approx, num_candidates - 1, axis=-1)
+            candidates = candidates[:, :num_candidates]
+            bound = np.take_along_axis(approx, candidates, axis=-1).max(axis=-1)
+            # rows with more references tied at the bound than candidates
+            tied = np.sum(approx <= bound[:, None], axis=-1) > num_candidates
+        else:
+            candidates = np.broadcast_to(np.arange(num_refs), approx.shape)
+            tied = np.zeros(shape=[len(chunk)], dtype=bool)
+        c_ids = np.sort(candidates, axis=-1)
+        for sub in range(0, len(chunk), 256):
+            rows = slice(sub, sub + 256)
+            c_dists = np.sum(
+                (chunk[rows, None, :] - references[c_ids[rows]]) ** 2, axis=-1
+            )
+            order = np.lexsort((c_ids[rows], c_dists), axis=-1)[:, :k]
+            ids[start + sub : start + sub + len(c_dists)] = np.take_along_axis(
+                c_ids[rows], order, axis=-1
+            )
+            dists[start + sub : start + sub + len(c_dists)] = np.take_along_axis(
+                c_dists, order, axis=-1
+            )
+        for row in np.flatnonzero(tied):
+            r_ids = np.flatnonzero(approx[row] <= bound[row])
+            r_dists = np.sum((chunk[row] - references[r_ids]) ** 2, axis=-1)
+            order = np.lexsort((r_ids, r_dists))[:k]
+            ids[start + row] = r_ids[order]
+            dists[start + row] = r_dists[order]
+    return ids, dists
@@ -0,0 +1,57 @@
+import argparse
+import os
+
+from utilities import (
+    iter_jsonl,
+    rebuild_articulations,
+    write_unique_articulations,
+    shard_name,
+)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--model", type=str)
+    arg_parser.add_argument("--method", type=str)
+    arg_parser.add_argument(
+        "--split",
+        type=str,
+        default="test",
+    )
+    arg_parser.add_argument(
+        "--data_path",
+        type=str,
+        default="/shared/hltdir4/disk1/team/data/corpora/co-vax-frames/covid19/co-vax-frames-test.jsonl",
+    )
+    arg_parser.add_argument(
+        "--art_path", type=str, default="/shared/aifiles/disk1/media/artifacts"
+    )
+    arg_parser.add_argument("--num_shards", type=int)
+
+    args = arg_parser.parse_args()
+
+    artifacts_path = os.path.join(
+        args.art_path, f"{args.model}-{args.method}-{args.split}", "articulations"
+    )
+    pred_path = os.path.join(artifacts_path, "predictions")
+
+    # examples a replay missed are articulated by a later --resume run, after
+    # the ones that followed them, so shards are not in data order; examples
+    # are found by id instead and written in data order
+    num_examples, num_frames = rebuild_articulations(
+        [
+            os.path.join(pred_path, shard_name(shard, args.num_shards))
+            for shard in range(args.num_shards)
+        ],
+        pred_path,
+        [ex["id"] for ex in iter_jsonl(args.data_path, fields=["id"])],
+    )
+
+    num_unique = write_unique_articulations(
+        os.path.join(pred_path, "articulations-full.jsonl"),
+        os.path.join(pred_path, "articulations-unique.jsonl"),
+    )
+
+    print(f"Articulated {num_examples} examples")
+    print(f"Found {num_frames} frames")
+    print(f"Found {num_unique} unique frames")
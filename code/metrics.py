@@ -0,0 +1,141 @@
+import bisect
+import threading
+import time
+from collections import defaultdict
+
+import ujson as json
+
+from ratelimit import error_status
+
+
+# upper bounds in seconds of the call latency histogram buckets
+LATENCY_BUCKETS = [
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, float("inf")
+]
+
+
+class APIMetrics:
+    # counters for everything a run spends its time on: provider calls,
+    # rate-limit and backoff sleeps, and cache lookups and writes
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.calls = 0
+        self.latency_counts = [0] * len(LATENCY_BUCKETS)
+        self.latency_seconds = 0.0
+        self.max_latency = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.retries = defaultdict(int)
+        self.failures = defaultdict(int)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_seconds = 0.0
+        self.sleep_seconds = 0.0
+
+    def record_call(self, latency, usage=None):
+        with self.lock:
+            self.calls += 1
+            self.latency_counts[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            self.latency_seconds += latency
+            self.max_latency = max(self.max_latency, latency)
+            if usage:
+                self.prompt_tokens += usage.get("prompt_tokens") or 0
+                self.completion_tokens += usage.get("completion_tokens") or 0
+
+    @staticmethod
+    def error_class(e):
+        status = error_status(e)
+        name = type(e).__name__
+        return name if status is None else f"{name} ({status})"
+
+    def record_retry(self, e):
+        with self.lock:
+            self.retries[self.error_class(e)] += 1
+
+    def record_failure(self, e):
+        with self.lock:
+            self.failures[self.error_class(e)] += 1
+
+    def record_cache(self, hit, seconds):
+        with self.lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+            self.cache_seconds += seconds
+
+    def record_cache_write(self, seconds):
+        with self.lock:
+            self.cache_seconds += seconds
+
+    def record_sleep(self, seconds):
+        if seconds > 0:
+            with self.lock:
+                self.sleep_seconds += seconds
+
+    def latency_quantile(self, q):
+        # upper bound of the bucket holding the q-th call, None before any call
+        with self.lock:
+            target = q * self.calls
+            seen = 0
+            for bound, count in zip(LATENCY_BUCKETS, self.latency_counts):
+                seen += count
+                if count > 0 and seen >= target:
+                    return min(bound, self.max_latency)
+        return None
+
+    def postfix(self):
+        # short live summary for tqdm.set_postfix
+        lookups = self.cache_hits + self.cache_misses
+        p50 = self.latency_quantile(0.5)
+        p95 = self.latency_quantile(0.95)
+        return {
+            "calls": self.calls,
+            "hit": f"{100 * self.cache_hits / max(lookups, 1):.0f}%",
+            "p50": "-" if p50 is None else f"{p50:.2f}s",
+            "p95": "-" if p95 is None else f"{p95:.2f}s",
+            "retries": sum(self.retries.values()),
+            "slept": f"{self.sleep_seconds:.0f}s",
+        }
+
+    def summary(self):
+        elapsed = time.monotonic() - self.start
+        lookups = self.cache_hits + self.cache_misses
+        with self.lock:
+            histogram = {
+                ("inf" if bound == float("inf") else str(bound)): count
+                for bound, count in zip(LATENCY_BUCKETS, self.latency_counts)
+            }
+        return {
+            "elapsed_seconds": elapsed,
+            "calls": self.calls,
+            "calls_per_second": self.calls / elapsed if elapsed > 0 else 0.0,
+            "latency": {
+                "mean_seconds": self.latency_seconds / max(self.calls, 1),
+                "p50_seconds": self.latency_quantile(0.5),
+                "p95_seconds": self.latency_quantile(0.95),
+                "p99_seconds": self.latency_quantile(0.99),
+                "max_seconds": self.max_latency,
+                "total_seconds": self.latency_seconds,
+                "histogram": histogram,
+            },
+            "tokens": {
+                "prompt": self.prompt_tokens,
+                "completion": self.completion_tokens,
+                "total": self.prompt_tokens + self.completion_tokens,
+            },
+            "retries": dict(self.retries),
+            "failures": dict(self.failures),
+            "cache": {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "hit_rate": self.cache_hits / lookups if lookups > 0 else 0.0,
+                "seconds": self.cache_seconds,
+            },
+            "sleep_seconds": self.sleep_seconds,
+        }
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
@@ -0,0 +1,378 @@
+import argparse
+import random
+import re
+import threading
+import time
+from collections import deque
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ujson as json
+
+from api import ChatAPI
+from cache import ResponseCache
+from ratelimit import RateLimiter
+
+
+PROBLEMS = [
+    "confidence",
+    "conspiracy",
+    "complacency",
+    "calculation",
+    "collective responsibility",
+    "compliance",
+    "constraints",
+]
+SUBJECTS = [
+    "The COVID-19 vaccine",
+    "Vaccine mandates",
+    "Natural immunity",
+    "Vaccine passports",
+    "Booster shots",
+    "The vaccine rollout",
+    "Pharmaceutical companies",
+    "Vaccinating children",
+]
+CLAIMS = [
+    "is unsafe",
+    "is necessary",
+    "violates personal freedom",
+    "protects the community",
+    "was rushed",
+    "is not effective",
+    "is a government plot",
+    "is the fastest way to end the pandemic",
+]
+CAUSES = [
+    "it has not been tested enough",
+    "it prevents severe illness",
+    "the risks of COVID-19 are low",
+    "the side effects are unknown",
+    "scientists have worked on it for decades",
+    "people are being forced to take it",
+    "it is hard to get an appointment",
+    "it reduces hospitalizations",
+]
+CONTEXTS = [
+    "",
+    " for young people",
+    " for the elderly",
+    " for pregnant women",
+    " in rural areas",
+    " for healthcare workers",
+    " in schools",
+    " for people who already had COVID-19",
+    " in the long term",
+    " according to the CDC",
+]
+RELATIONS = ["Paraphrases", "Specializes", "Contradicts"]
+# what chatty local models tend to add after the structured answer
+RAMBLE = (
+    "\n\nNote: these framings were identified from the text of the tweet alone, "
+    "and other readers may interpret the tweet differently. Framing analysis "
+    "is inherently subjective, and the reasoning above is only one possible "
+    "reading. Let me know if you would like me to explain any of them in more "
+    "detail, or to look at additional tweets."
+)
+
+
+class MockError(Exception):
+    def __init__(self, message, http_status, headers=None):
+        super().__init__(message)
+        self.http_status = http_status
+        self.headers = headers or {}
+
+
+def request_seed(text):
+    return int(md5(text.encode()).hexdigest()[:12], 16)
+
+
+def mock_frame(seed):
+    subject = SUBJECTS[seed % len(SUBJECTS)]
+    claim = CLAIMS[(seed // 7) % len(CLAIMS)]
+    cause = CAUSES[(seed // 53) % len(CAUSES)]
+    context = CONTEXTS[(seed // 419) % len(CONTEXTS)]
+    return f"{subject} {claim}{context} because {cause}."
+
+
+def mock_articulation(text, num_frames=20000):
+    # 1-3 frames drawn from a fixed pool, so duplicates accumulate counts
+    seed = request_seed(text)
+    lines = []
+    for i in range(1, 1 + seed % 3 + 1):
+        f_seed = (seed >> (8 * i)) % num_frames
+        problem = PROBLEMS[f_seed % len(PROBLEMS)]
+        lines.append(
+            f"{i}.a: This tweet contains a framing, as the problem of {problem} "
+            f"is due to the cause that {CAUSES[f_seed % len(CAUSES)]}."
+        )
+        lines.append(f"{i}.b: {mock_frame(f_seed)}")
+    return "\n".join(lines)
+
+
+def mock_relation(block, prefix=""):
+    numbers = re.findall(r"^(\d+):", block, flags=re.MULTILINE)
+    seed = request_seed(block)
+    if len(numbers) < 2 or seed % 5 < 2:
+        return f"{prefix}a: There is no relationship."
+    n = int(numbers[-1])
+    y = int(numbers[seed % (len(numbers) - 1)])
+    rt = RELATIONS[(seed // 5) % len(RELATIONS)]
+    problem = PROBLEMS[(seed // 17) % len(PROBLEMS)]
+    return (
+        f"{prefix}a: There is a {rt.lower()} relationship between {n} and {y}, "
+        f"as both framings discuss the problem of {problem}.\n"
+        f"{prefix}b: {rt}({n},{y})"
+    )
+
+
+def mock_answer(text):
+    if "Group 1:" in text:
+        blocks = re.split(r"^Group \d+:$", text, flags=re.MULTILINE)[1:]
+        return "\n".join(
+            mock_relation(block, prefix=f"{g}.") for g, block in enumerate(blocks, 1)
+        )
+    if text.startswith("Similar known framings:"):
+        return mock_relation(text)
+    return mock_articulation(text)
+
+
+class MockAPI(ChatAPI):
+    # offline stand-in with well-formed articulation and relation answers,
+    # simulated latency, provider errors and a provider-side rate limit
+    backend = "mock"
+
+    def __init__(
+        self,
+        model: str,
+        temperature: float = 0,
+        max_tokens: int = 512,
+        latency: float = 1.0,
+        latency_dist: str = "lognormal",
+        error_rate: float = 0.0,
+        provider_rpm: float = None,
+        rate_limiter: RateLimiter = None,
+        max_retries: int = 8,
+        cache: ResponseCache = None,
+        legacy_cache: ResponseCache = None,
+        seed: int = 0,
+    ):
+        super().__init__(
+            None,
+            None,
+            rate_limiter,
+            max_retries,
+            backoff_seconds=min(latency, 1),
+            cache=cache,
+            legacy_cache=legacy_cache,
+        )
+        self.model = model
+        self.api_model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.error_rate = error_rate
+        self.provider_rpm = provider_rpm
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.recent_calls = deque()
+        self.num_calls = 0
+
+    def sample_latency(self):
+        with self.lock:
+            if self.latency_dist == "constant":
+                return self.latency
+            elif self.latency_dist == "exponential":
+                return self.random.expovariate(1 / self.latency)
+            elif self.latency_dist == "lognormal":
+                # sigma of 0.5 gives the long tail seen from hosted providers
+                return self.latency * self.random.lognormvariate(-0.125, 0.5)
+            else:
+                raise ValueError(f"Unknown latency distribution: {self.latency_dist}")
+
+    def check_provider_limit(self):
+        with self.lock:
+            self.num_calls += 1
+            if self.provider_rpm is None:
+                return
+            now = time.monotonic()
+            while self.recent_calls and now - self.recent_calls[0] > 60:
+                self.recent_calls.popleft()
+            if len(self.recent_calls) >= self.provider_rpm:
+                retry = 60 - (now - self.recent_calls[0])
+                raise MockError(
+                    "Rate limit reached", 429, {"retry-after": f"{retry:.2f}"}
+                )
+            self.recent_calls.append(now)
+
+    def create(self, messages, stop_when=None):
+        self.check_provider_limit()
+        time.sleep(self.sample_latency())
+        with self.lock:
+            failed = self.random.random() < self.error_rate
+        if failed:
+            raise MockError("The server is overloaded", 503)
+        content = mock_answer(messages[-1]["content"])
+        prompt_tokens = sum(len(m["content"]) for m in messages) // 4
+        return {
+            "choices": [
+                {
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(content) // 4,
+                "total_tokens": prompt_tokens + len(content) // 4,
+            },
+        }
+
+    def build_message(self, text: str):
+        return {"role": "user", "content": text}
+
+    def process_response(self, response):
+        message = {
+            "role": "assistant",
+            "content": response["choices"][0]["message"]["content"],
+        }
+        return message
+
+
+class StandInServer(ThreadingHTTPServer):
+    # large accept backlog, so bursts of new connections are not reset
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # minimal OpenAI-compatible chat completions endpoint, streamed or not,
+    # which generates one word per token_latency and stops when the client
+    # disconnects, like vLLM and FastChat do
+    protocol_version = "HTTP/1.1"
+    token_latency = 0.01
+    ramble = True
+    stats = {"requests": 0, "tokens": 0, "cancelled": 0}
+    stats_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json(200, {"object": "list", "data": [{"id": "mock"}]})
+        elif self.path.rstrip("/").endswith("/stats"):
+            with self.stats_lock:
+                self.send_json(200, dict(self.stats))
+        else:
+            self.send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": "Not found"}})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length))
+        content = mock_answer(request["messages"][-1]["content"])
+        if self.ramble:
+            content += RAMBLE
+        tokens = re.findall(r"\S+\s*|\s+", content)[: request.get("max_tokens", 512)]
+        with self.stats_lock:
+            self.stats["requests"] += 1
+        if request.get("stream"):
+            self.stream_tokens(request, tokens)
+            return
+        time.sleep(self.token_latency * len(tokens))
+        self.count_tokens(len(tokens))
+        self.send_json(
+            200,
+            {
+                "object": "chat.completion",
+                "model": request["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "".join(tokens)},
+                        "finish_reason": "length",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": sum(
+                        len(m["content"]) for m in request["messages"]
+                    )
+                    // 4,
+                    "completion_tokens": len(tokens),
+                },
+            },
+        )
+
+    def count_tokens(self, num_tokens, cancelled=False):
+        with self.stats_lock:
+            self.stats["tokens"] += num_tokens
+            self.stats["cancelled"] += cancelled
+
+    def stream_tokens(self, request, tokens):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send_event(data):
+            line = f"data: {data}\n\n".encode()
+            self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+            self.wfile.flush()
+
+        def chunk(delta, finish_reason=None):
+            return json.dumps(
+                {
+                    "object": "chat.completion.chunk",
+                    "model": request["model"],
+                    "choices": [
+                        {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                    ],
+                }
+            )
+
+        sent = 0
+        try:
+            send_event(chunk({"role": "assistant"}))
+            for token in tokens:
+                time.sleep(self.token_latency)
+                send_event(chunk({"content": token}))
+                sent += 1
+            send_event(chunk({}, "length"))
+            send_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # client stopped reading, so generation stops here
+            self.count_tokens(sent, cancelled=True)
+            self.close_connection = True
+            return
+        self.count_tokens(sent)
+
+
+if __name__ == "__main__":
+    # local stand-in for an OpenAI-compatible server, e.g. for
+    # articulate.py --api openai --base_api http://localhost:8000/v1 --stream
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--host", type=str, default="localhost")
+    arg_parser.add_argument("--port", type=int, default=8000)
+    arg_parser.add_argument("--token_latency", type=float, default=0.01)
+    arg_parser.add_argument("--no_ramble", action="store_true")
+
+    args = arg_parser.parse_args()
+    StandInHandler.token_latency = args.token_latency
+    StandInHandler.ramble = not args.no_ramble
+    server = StandInServer((args.host, args.port), StandInHandler)
+    print(f"Serving mock chat completions on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
@@ -0,0 +1,174 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = {
+    "RateLimitError",
+    "APIError",
+    "APIConnectionError",
+    "ServiceUnavailableError",
+    "Timeout",
+    "TryAgain",
+    "ConnectionError",
+    "TimeoutError",
+    "ReadTimeout",
+    "ConnectTimeout",
+    "RemoteProtocolError",
+}
+FATAL_ERRORS = {
+    "AuthenticationError",
+    "PermissionError",
+    "InvalidRequestError",
+    "InvalidAPIType",
+    "SignatureVerificationError",
+    "KeyError",
+    "ValueError",
+    "TypeError",
+}
+FATAL_MESSAGES = [
+    "maximum context length",
+    "context_length_exceeded",
+    "incorrect api key",
+    "invalid api key",
+    "invalid token",
+    "unauthenticated",
+]
+# fatal errors that every later request would hit too, so the run must stop;
+# other fatal errors belong to one request, such as an overlong prompt
+CONFIG_STATUS = {401, 403, 404}
+CONFIG_ERRORS = {
+    "AuthenticationError",
+    "PermissionError",
+    "PermissionDeniedError",
+    "NotFoundError",
+    "InvalidAPIType",
+    "SignatureVerificationError",
+}
+CONFIG_MESSAGES = [
+    "incorrect api key",
+    "invalid api key",
+    "invalid token",
+    "unauthenticated",
+    "model not found",
+    "model_not_found",
+]
+
+
+class TokenBucket:
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute if capacity is None else capacity
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        # take tokens now, possibly going negative, and return how long the
+        # caller must wait before the reservation is covered
+        amount = min(amount, self.capacity)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class RateLimiter:
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = None if rpm is None else TokenBucket(rpm)
+        self.tokens = None if tpm is None else TokenBucket(tpm)
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        # takes the request from both budgets, returns how long to wait first
+        wait = max(0.0, self.blocked_until - time.monotonic())
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(tokens))
+        return wait
+
+    def acquire(self, tokens=1):
+        # blocks until both budgets allow the request, returns seconds slept
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        # provider asked us to back off, so hold every caller sharing this limiter
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def error_status(e):
+    for attr in ["http_status", "status_code", "status"]:
+        status = getattr(e, attr, None)
+        if isinstance(status, int):
+            return status
+    response = getattr(e, "response", None)
+    status = getattr(response, "status_code", None)
+    if isinstance(status, int):
+        return status
+    return None
+
+
+def is_retryable(e):
+    message = str(e).lower()
+    if any(m in message for m in FATAL_MESSAGES):
+        return False
+    status = error_status(e)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    name = type(e).__name__
+    if name in FATAL_ERRORS:
+        return False
+    # unknown errors are retried, as before, but only a bounded number of times
+    return True
+
+
+def is_config_error(e):
+    message = str(e).lower()
+    if any(m in message for m in CONFIG_MESSAGES):
+        return True
+    if error_status(e) in CONFIG_STATUS:
+        return True
+    return type(e).__name__ in CONFIG_ERRORS
+
+
+def retry_after(e):
+    headers = getattr(e, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(e, "response", None), "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base_seconds, max_seconds=120, retry_after_seconds=None):
+    # exponential backoff with full jitter, never shorter than Retry-After
+    delay = random.uniform(0, min(max_seconds, base_seconds * 2**attempt))
+    if retry_after_seconds is not None:
+        delay = max(delay, retry_after_seconds)
+    return delay
@@ -1,15 +1,24 @@
 import argparse
 import os
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
 import numpy as np
 from tqdm import tqdm
-from sentence_transformers import SentenceTransformer
-import networkx as nx
+import ujson as json
 
+from index import ActiveIndex
+from embeddings import EmbeddingStore, HashingEncoder
 from utilities import (
     read_jsonl,
+    iter_jsonl,
     write_jsonl,
+    truncate_jsonl,
+    JsonlWriter,
     format_prompt,
     extract_relations,
+    extract_batch_relations,
+    relation_complete,
+    batch_relation_complete,
     rel_order,
     format_reasoning,
     build_api,
@@ -17,6 +26,278 @@ from utilities import (
 from collections import defaultdict
 
 
+BATCH_INSTRUCTION = (
+    "Answer each group of framings below separately, in order. "
+    "Prefix every answer line with the group number, "
+    "for example 1.a: and 1.b: for group 1."
+)
+
+
+class RelationWriter:
+    # appends responses and relations as each frame completes, and every
+    # checkpoint_every frames saves the active set and how far the run got to
+    # relations-state.json, so a run can resume after a crash, or later carry
+    # on with the frames appended to articulations-unique.jsonl since
+    def __init__(self, pred_path, settings, resume=False, checkpoint_every=1000):
+        self.settings = settings
+        self.checkpoint_every = checkpoint_every
+        self.paths = {
+            "responses": os.path.join(pred_path, "responses.jsonl"),
+            "relations": os.path.join(pred_path, "relations.jsonl"),
+            "state": os.path.join(pred_path, "relations-state.json"),
+        }
+        self.state = None
+        self.num_responses = 0
+        self.num_relations = 0
+        self.next_idx = 1
+        self.last_checkpoint = 1
+        # digest of the text of every frame before next_idx
+        self.digest = sha1()
+        if resume:
+            self.resume()
+        # first frame of this run, where its batches start
+        self.start = self.next_idx
+        mode = "a" if self.state is not None else "w"
+        self.files = {
+            k: JsonlWriter(self.paths[k], mode) for k in ["responses", "relations"]
+        }
+
+    def resume(self):
+        if not os.path.exists(self.paths["state"]):
+            return
+        with open(self.paths["state"], "r") as f:
+            self.state = json.load(f)
+        for k, v in self.settings.items():
+            if self.state["settings"].get(k) != v:
+                raise ValueError(
+                    f"Cannot resume with {k}={v}, the saved state has "
+                    f'{k}={self.state["settings"].get(k)}'
+                )
+        self.num_responses = self.state["num_responses"]
+        self.num_relations = self.state["num_relations"]
+        self.next_idx = self.state["next_idx"]
+        self.last_checkpoint = self.next_idx
+        # anything written after the last checkpoint is redone
+        truncate_jsonl(self.paths["responses"], self.num_responses)
+        truncate_jsonl(self.paths["relations"], self.num_relations)
+
+    def restore(self, frames, index):
+        # the frames seen so far must not have changed, only new ones appended
+        if self.state is None:
+            self.digest.update(frames[0]["text"].encode() + b"\n")
+            index.add(0)
+            return
+        if len(frames) < self.next_idx:
+            raise ValueError(
+                f"Saved state covers {self.next_idx} frames, found {len(frames)}"
+            )
+        for f_idx in range(self.next_idx):
+            self.digest.update(frames[f_idx]["text"].encode() + b"\n")
+        if self.digest.hexdigest() != self.state["digest"]:
+            raise ValueError("Frames seen by the saved state have changed")
+        for f_idx in self.state["active"]:
+            index.add(f_idx)
+
+    def write(self, frames, index, f_idx, response, relations):
+        self.digest.update(frames[f_idx]["text"].encode() + b"\n")
+        if response is not None:
+            self.files["responses"].write(response)
+            self.num_responses += 1
+        for rel in relations:
+            self.files["relations"].write(
+                {
+                    "type": rel["type"],
+                    "x": int(rel["x"]),
+                    "y": int(rel["y"]),
+                    "reasoning": format_reasoning(rel["reasoning"]),
+                }
+            )
+            self.num_relations += 1
+        self.next_idx = f_idx + 1
+        # batches are never split, so a resumed run sends the same requests
+        batch_size = self.settings["batch_size"]
+        if (
+            (self.next_idx - self.start) % batch_size == 0
+            and self.next_idx - self.last_checkpoint >= self.checkpoint_every
+        ):
+            self.checkpoint(index)
+
+    def checkpoint(self, index):
+        for f in self.files.values():
+            f.flush()
+        state = {
+            "settings": self.settings,
+            "next_idx": self.next_idx,
+            "num_responses": self.num_responses,
+            "num_relations": self.num_relations,
+            "digest": self.digest.hexdigest(),
+            "active": index.ids[: index.size].tolist(),
+        }
+        tmp_path = self.paths["state"] + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.paths["state"])
+        self.last_checkpoint = self.next_idx
+
+    def close(self, index):
+        self.checkpoint(index)
+        for f in self.files.values():
+            f.close()
+
+
+def build_relation_prompt(frames, index, f_idx, top_k):
+    f_sorted, _ = index.search(f_idx, top_k)
+    lines = ["Similar known framings:"]
+    f_map = {}
+    i = 1
+    for c_idx in f_sorted:
+        f_text = frames[c_idx]["text"]
+        f_text = format_prompt(f_text)
+        lines.append(f"{i}: {f_text}")
+        f_map[i] = c_idx
+        i += 1
+    lines.append("New framing:")
+    text = format_prompt(frames[f_idx]["text"])
+    f_map[i] = f_idx
+    lines.append(f"{i}: {text}")
+    line = "\n".join(lines)
+    return format_prompt(line), f_map, tuple(f_sorted)
+
+
+def update_active(frames, index, f_idx, relations):
+    if len(relations) == 0:
+        # add frame to active frames if no relation
+        index.add(f_idx)
+    for rel in sorted(relations, key=lambda x: rel_order(x)):
+        if rel["type"] == "paraphrases":
+            # only keep shorter, by default we keep the one already in play
+            if len(frames[rel["x"]]["text"]) < len(frames[rel["y"]]["text"]):
+                index.add(rel["x"])
+                index.remove(rel["y"])
+            break
+        elif rel["type"] == "specializes":
+            # keep both specific and general
+            # keep both, so add new one
+            index.add(f_idx)
+            break
+        elif rel["type"] == "contradicts":
+            # keep both, so add new one
+            index.add(f_idx)
+            break
+        else:
+            print(f'Unknown relation type: {rel["type"]}')
+
+
+def discover_relations(
+    api, prompt_messages, frames, index, top_k, start=1, workers=1, batch_size=1
+):
+    # yields (f_idx, response, relations) in frame order, exactly as the
+    # sequential algorithm would produce them
+    def submit(line, stop_when=relation_complete):
+        # async apis run the request on their own event loop
+        return api.submit(prompt_messages + [api.build_message(line)], stop_when)
+
+    def send(line, stop_when=relation_complete):
+        if getattr(api, "is_async", False):
+            return submit(line, stop_when).result()
+        return api.send(prompt_messages + [api.build_message(line)], stop_when)
+
+    if batch_size > 1:
+        # several new framings share one request, so they are all compared
+        # against the active set from before the batch; the response is
+        # yielded with the first frame of its batch only
+        for b_start in range(start, len(frames), batch_size):
+            b_idxs = list(range(b_start, min(b_start + batch_size, len(frames))))
+            lines = [BATCH_INSTRUCTION]
+            f_maps = []
+            for g_idx, f_idx in enumerate(b_idxs):
+                line, f_map, _ = build_relation_prompt(frames, index, f_idx, top_k)
+                lines.append(f"Group {g_idx + 1}:")
+                lines.append(line)
+                f_maps.append(f_map)
+            response = send("\n".join(lines), batch_relation_complete)
+            b_relations = extract_batch_relations(response, f_maps)
+            for g_idx, (f_idx, relations) in enumerate(zip(b_idxs, b_relations)):
+                update_active(frames, index, f_idx, relations)
+                yield f_idx, response if g_idx == 0 else None, relations
+        return
+
+    if workers <= 1:
+        for f_idx in range(start, len(frames)):
+            line, f_map, _ = build_relation_prompt(frames, index, f_idx, top_k)
+            response = send(line)
+            relations = extract_relations(response, f_map)
+            update_active(frames, index, f_idx, relations)
+            yield f_idx, response, relations
+        return
+
+    # speculative mode: prompts for the next frames are dispatched with the
+    # current active set, and whenever an answer changes the active set the
+    # pending prompts whose candidate list changed are re-issued
+    reissued = 0
+    embeddings = index.embeddings
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        def dispatch(p_idx):
+            line, _, candidates = build_relation_prompt(frames, index, p_idx, top_k)
+            if getattr(api, "is_async", False):
+                future = submit(line)
+            else:
+                future = executor.submit(send, line)
+            pending[p_idx] = (candidates, future)
+
+        def affected(p_idx, candidates, added, removed):
+            # an added frame only matters when closer than the k-th candidate,
+            # a removed one when it is a candidate; distances get a little slack
+            # so rounding never hides a change, the prompt rebuild is exact
+            if any(r_idx in candidates for r_idx in removed):
+                return True
+            if len(added) == 0:
+                return False
+            if len(candidates) < top_k:
+                return True
+            query = embeddings[p_idx]
+            kth_dist = np.sum((embeddings[candidates[-1]] - query) ** 2)
+            dists = np.sum((embeddings[added] - query) ** 2, axis=-1)
+            return bool(np.any(dists <= kth_dist * (1 + 1e-5) + 1e-12))
+
+        next_idx = start
+        for f_idx in range(start, len(frames)):
+            while next_idx < len(frames) and next_idx < f_idx + workers:
+                dispatch(next_idx)
+                next_idx += 1
+            _, f_map, candidates = build_relation_prompt(frames, index, f_idx, top_k)
+            dispatched, future = pending.pop(f_idx)
+            if candidates != dispatched:
+                future.cancel()
+                reissued += 1
+                dispatch(f_idx)
+                dispatched, future = pending.pop(f_idx)
+            response = future.result()
+            relations = extract_relations(response, f_map)
+            # the active set can only change in the frames named here
+            touched = {f_idx} | {r[k] for r in relations for k in ["x", "y"]}
+            before = {t_idx for t_idx in touched if t_idx in index}
+            update_active(frames, index, f_idx, relations)
+            after = {t_idx for t_idx in touched if t_idx in index}
+            added = sorted(after - before)
+            removed = before - after
+            if len(added) > 0 or len(removed) > 0:
+                for p_idx, (dispatched, future) in list(pending.items()):
+                    if not affected(p_idx, dispatched, added, removed):
+                        continue
+                    _, _, candidates = build_relation_prompt(
+                        frames, index, p_idx, top_k
+                    )
+                    if candidates != dispatched:
+                        future.cancel()
+                        reissued += 1
+                        dispatch(p_idx)
+            yield f_idx, response, relations
+    print(f"Re-issued {reissued} stale speculative requests")
+
+
 if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument("--model", type=str)
@@ -24,6 +305,16 @@ if __name__ == "__main__":
     arg_parser.add_argument("--method", type=str)
     arg_parser.add_argument("--api", type=str)
     arg_parser.add_argument("--api_key", type=str, default=None)
+    arg_parser.add_argument("--replay_api", type=str, default=None)
+    arg_parser.add_argument("--base_api", type=str, default=None)
+    arg_parser.add_argument("--router_api", type=str, default="fastchat")
+    arg_parser.add_argument("--endpoints", type=str, default=None)
+    arg_parser.add_argument(
+        "--route",
+        type=str,
+        default="least_outstanding",
+        choices=["least_outstanding", "latency"],
+    )
     arg_parser.add_argument(
         "--split",
         type=str,
@@ -37,11 +328,47 @@ if __name__ == "__main__":
     arg_parser.add_argument(
         "--art_path", type=str, default="/shared/aifiles/disk1/media/artifacts"
     )
+    arg_parser.add_argument("--emb_path", type=str, default=None)
     arg_parser.add_argument("--temperature", type=float, default=0)
     arg_parser.add_argument("--max_tokens", type=int, default=512)
+    arg_parser.add_argument("--rpm", type=float, default=None)
+    arg_parser.add_argument("--tpm", type=float, default=None)
+    arg_parser.add_argument("--max_retries", type=int, default=8)
+    arg_parser.add_argument("--stream", action="store_true")
+    arg_parser.add_argument(
+        "--transport", type=str, default="sync", choices=["sync", "async"]
+    )
+    arg_parser.add_argument("--max_connections", type=int, default=100)
+    arg_parser.add_argument("--max_keepalive", type=int, default=20)
+    # replicate predictions are submitted and polled together, with at most
+    # max_inflight running; only the next --workers frames are sent ahead,
+    # so raise --workers to keep pipelined and async apis busy
+    arg_parser.add_argument("--replicate_pipeline", action="store_true")
+    arg_parser.add_argument("--max_inflight", type=int, default=32)
+    arg_parser.add_argument("--deadline", type=float, default=600)
+    arg_parser.add_argument(
+        "--cache", type=str, default="file", choices=["file", "sqlite"]
+    )
+    arg_parser.add_argument("--cache_dir", type=str, default=None)
+    arg_parser.add_argument("--mock_latency", type=float, default=1.0)
+    arg_parser.add_argument(
+        "--mock_latency_dist",
+        type=str,
+        default="lognormal",
+        choices=["constant", "exponential", "lognormal"],
+    )
+    arg_parser.add_argument("--mock_error_rate", type=float, default=0.0)
+    arg_parser.add_argument("--mock_rpm", type=float, default=None)
     arg_parser.add_argument("--top_k", type=int, default=10)
+    arg_parser.add_argument("--workers", type=int, default=1)
+    arg_parser.add_argument("--batch_size", type=int, default=1)
+    # carry on from relations-state.json, after a crash or with new frames
+    arg_parser.add_argument("--resume", action="store_true")
+    arg_parser.add_argument("--checkpoint_every", type=int, default=1000)
 
     args = arg_parser.parse_args()
+    if args.emb_path is None:
+        args.emb_path = os.path.join(args.art_path, "embeddings")
     data_path = os.path.join(
         args.art_path, f"{args.model}-{args.method}-{args.split}", "articulations"
     )
@@ -51,7 +378,8 @@ if __name__ == "__main__":
     os.makedirs(artifacts_path, exist_ok=True)
 
     frames = read_jsonl(
-        os.path.join(data_path, "predictions", "articulations-unique.jsonl")
+        os.path.join(data_path, "predictions", "articulations-unique.jsonl"),
+        fields=["text"],
     )
 
     prompt_messages = read_jsonl(
@@ -63,87 +391,74 @@ if __name__ == "__main__":
     api = build_api(args, artifacts_path)
 
     if args.similarity == "sbert":
-        embed = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+        # imported here so --similarity hashing runs without torch
+        from sentence_transformers import SentenceTransformer
+
+        embed = EmbeddingStore(
+            args.emb_path,
+            "sentence-transformers/all-MiniLM-L6-v2",
+            SentenceTransformer,
+        )
+    elif args.similarity == "hashing":
+        embed = EmbeddingStore(args.emb_path, "hashing-384", HashingEncoder)
     else:
         raise ValueError(f"Unknown similarity: {args.similarity}")
 
-    a_embs = embed.encode([f["text"] for f in frames], show_progress_bar=True)
-    fdists = np.sum((a_embs[:, None] - a_embs[None, :]) ** 2, axis=-1)
-    current_mask = np.zeros(shape=[len(frames)], dtype=np.float32)
-    current_mask[0] = 1.0
-    all_relations = []
-    current_index = 1
-    responses = []
-    with tqdm(total=len(frames)) as pbar:
-        pbar.update(current_index)
-        while current_index < len(frames):
-            ex = frames[current_index]
-            ex_dists = fdists[current_index] + (1.0 - current_mask) * 1e6
-            f_sorted = np.argsort(ex_dists)[: args.top_k]
-            lines = ["Similar known framings:"]
-            f_map = {}
-            i = 1
-            for f_idx in f_sorted:
-                if ex_dists[f_idx] > 1e5:
-                    continue
-                f_text = frames[f_idx]["text"]
-                f_text = format_prompt(f_text)
-                lines.append(f"{i}: {f_text}")
-                f_map[i] = f_idx
-                i += 1
-            lines.append("New framing:")
-            text = format_prompt(ex["text"])
-            f_map[i] = current_index
-            lines.append(f"{i}: {text}")
-            line = "\n".join(lines)
-            message = api.build_message(format_prompt(line))
-            messages = prompt_messages + [message]
-            response = api.send(messages)
-            responses.append(response)
-            relations = extract_relations(response, f_map)
-            if len(relations) == 0:
-                # add frame to active frames if no relation
-                current_mask[current_index] = 1.0
-            all_relations.extend(relations)
-            for rel in sorted(relations, key=lambda x: rel_order(x)):
-                if rel["type"] == "paraphrases":
-                    # only keep shorter, by default we keep the one already in play
-                    if len(frames[rel["x"]]["text"]) < len(frames[rel["y"]]["text"]):
-                        current_mask[rel["x"]] = 1.0
-                        current_mask[rel["y"]] = 0.0
-                    break
-                elif rel["type"] == "specializes":
-                    # keep both specific and general
-                    # keep both, so add new one
-                    current_mask[current_index] = 1.0
-                    break
-                elif rel["type"] == "contradicts":
-                    # keep both, so add new one
-                    current_mask[current_index] = 1.0
-                    break
-                else:
-                    print(f'Unknown relation type: {rel["type"]}')
-            current_index += 1
-            pbar.update(1)
-
     pred_path = os.path.join(artifacts_path, "predictions")
     os.makedirs(pred_path, exist_ok=True)
+    writer = RelationWriter(
+        pred_path,
+        settings={
+            "method": args.method,
+            "similarity": embed.model_name,
+            "top_k": args.top_k,
+            "batch_size": args.batch_size,
+        },
+        resume=args.resume,
+        checkpoint_every=args.checkpoint_every,
+    )
+
+    a_embs = embed.encode([f["text"] for f in frames], show_progress_bar=True)
+    # only active frames are candidates, so search those instead of an N x N matrix
+    index = ActiveIndex(a_embs)
+    writer.restore(frames, index)
+    start = writer.next_idx
+    if args.resume:
+        print(f"Resuming at frame {start} of {len(frames)}")
+    missed_idxs = []
+    with tqdm(total=len(frames), initial=start) as pbar:
+        for f_idx, response, relations in discover_relations(
+            api,
+            prompt_messages,
+            frames,
+            index,
+            args.top_k,
+            start=start,
+            workers=args.workers,
+            batch_size=args.batch_size,
+        ):
+            if response is None and (
+                args.api == "replay" and (f_idx - start) % args.batch_size == 0
+            ):
+                # a missing answer is treated as no relation, which changes
+                # the active set for every later frame
+                missed_idxs.append(f_idx)
+            writer.write(frames, index, f_idx, response, relations)
+            pbar.set_postfix(api.metrics.postfix(), refresh=False)
+            pbar.update(1)
+    writer.close(index)
 
-    cleaned_relations = []
-    for rel in all_relations:
-        cleaned_relations.append(
-            {
-                "type": rel["type"],
-                "x": int(rel["x"]),
-                "y": int(rel["y"]),
-                "reasoning": format_reasoning(rel["reasoning"]),
-            }
-        )
     rc = defaultdict(int)
-    for rel in cleaned_relations:
+    for rel in iter_jsonl(writer.paths["relations"], fields=["type"]):
         rc[rel["type"]] += 1
     for k, v in sorted(rc.items(), key=lambda x: x[1], reverse=True):
         print(k, v)
 
-    write_jsonl(cleaned_relations, os.path.join(pred_path, "relations.jsonl"))
-    write_jsonl(responses, os.path.join(pred_path, "responses.jsonl"))
+    api.metrics.dump(os.path.join(pred_path, "api-metrics.json"))
+    api.close()
+    if args.api == "replay":
+        write_jsonl(
+            [{"frame": f_idx} for f_idx in missed_idxs],
+            os.path.join(pred_path, "replay-misses.jsonl"),
+        )
+        print(f"Replay missed {len(missed_idxs)} requests")
@@ -1,16 +1,15 @@
 import argparse
 import os
-import numpy as np
-from tqdm import tqdm
-from sentence_transformers import SentenceTransformer
-import networkx as nx
 import ujson as json
 
+import graph
+from embeddings import EmbeddingStore, HashingEncoder
 from utilities import (
     read_jsonl,
     write_jsonl,
-    extract_problems,
-    count_problems,
+    ProblemTagger,
+    load_taxonomy,
+    print_problems,
     reduce_paraphrases,
     merge_relations,
     clean_reasoning,
@@ -18,6 +17,13 @@ from utilities import (
 from annotate import annotate_frames, annotate_relations
 
 
+def report_problems(tagger, tags, stage, pred_path):
+    counts, cooccurrence = tagger.report(tags)
+    print_problems(counts)
+    counts.to_csv(os.path.join(pred_path, f"problems-{stage}.csv"))
+    cooccurrence.to_csv(os.path.join(pred_path, f"problems-{stage}-cooccurrence.csv"))
+
+
 if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument("--model", type=str)
@@ -38,8 +44,16 @@ if __name__ == "__main__":
     arg_parser.add_argument(
         "--art_path", type=str, default="/shared/aifiles/disk1/media/artifacts"
     )
+    arg_parser.add_argument("--emb_path", type=str, default=None)
+    arg_parser.add_argument(
+        "--graph", type=str, default="array", choices=["array", "networkx"]
+    )
+    # json object of problem name to keywords, see PROBLEM_TAXONOMY
+    arg_parser.add_argument("--taxonomy", type=str, default=None)
 
     args = arg_parser.parse_args()
+    if args.emb_path is None:
+        args.emb_path = os.path.join(args.art_path, "embeddings")
     artifacts_path = os.path.join(
         args.art_path, f"{args.model}-{args.method}-{args.split}", "relevance"
     )
@@ -64,15 +78,32 @@ if __name__ == "__main__":
     os.makedirs(pred_path, exist_ok=True)
 
     if args.similarity == "sbert":
-        embed = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+        # imported here so --similarity hashing runs without torch
+        from sentence_transformers import SentenceTransformer
+
+        embed = EmbeddingStore(
+            args.emb_path,
+            "sentence-transformers/all-MiniLM-L6-v2",
+            SentenceTransformer,
+        )
+    elif args.similarity == "hashing":
+        embed = EmbeddingStore(args.emb_path, "hashing-384", HashingEncoder)
     else:
         raise ValueError(f"Unknown similarity: {args.similarity}")
 
-    count_problems(frames)
+    if args.graph == "array":
+        reduce_fn, merge_fn = graph.reduce_paraphrases, graph.merge_relations
+    else:
+        reduce_fn, merge_fn = reduce_paraphrases, merge_relations
+
+    # frames are tagged once, the later stages keep subsets of them
+    tagger = ProblemTagger(load_taxonomy(args.taxonomy))
+    tags = tagger.tag_frames(frames)
+    report_problems(tagger, tags, "articulated", pred_path)
 
     print(f"Found {len(frames)} frames before paraphrase reduction")
     print(f"Found {len(cleaned_relations)} relations before paraphrase reduction")
-    reduced_frames, reduced_relations, kept_nodes, reduced_count = reduce_paraphrases(
+    reduced_frames, reduced_relations, kept_nodes, reduced_count = reduce_fn(
         frames, cleaned_relations
     )
     print(f"Found {len(reduced_frames)} frames after paraphrase reduction")
@@ -84,15 +115,15 @@ if __name__ == "__main__":
         json.dump(reduced_count, f)
     write_jsonl(reduced_relations, os.path.join(pred_path, "reduced-relations.jsonl"))
 
-    count_problems(reduced_frames.values())
+    report_problems(tagger, tags[list(reduced_frames)], "reduced", pred_path)
 
-    merged_frames, merged_relations, merged_nodes, merged_count = merge_relations(
+    merged_frames, merged_relations, merged_nodes, merged_count = merge_fn(
         frames, reduced_relations, kept_nodes, reduced_count
     )
     print(f"Found {len(merged_frames)} frames after merge reduction")
     print(f"Found {len(merged_relations)} relations after merge reduction")
 
-    count_problems(merged_frames.values())
+    report_problems(tagger, tags[list(merged_frames)], "merged", pred_path)
     with open(os.path.join(pred_path, "merged-frames.json"), "w") as f:
         json.dump(merged_frames, f)
     with open(os.path.join(pred_path, "merged-count.json"), "w") as f:
@@ -104,7 +135,7 @@ if __name__ == "__main__":
         f = f.copy()
         f["count"] = merged_count[f_idx]
         f["f_id"] = f"F{f_idx}"
-        f["problems"] = extract_problems(f)
+        f["problems"] = tagger.problems_of(tags[f_idx])
         f["reasoning"] = clean_reasoning(f["reasoning"])
         new_frames.append(f)
 
@@ -137,6 +168,7 @@ if __name__ == "__main__":
         ann_frames_path,
         embed,
         ref_frames,
+        tagger=tagger,
     )
     ann_rel_path = os.path.join(
         pred_path, f"{args.model}-{args.method}-{args.split}-rels.xlsx"
@@ -0,0 +1,129 @@
+import argparse
+import os
+import shutil
+from multiprocessing import Pool
+
+import ujson as json
+from tqdm import tqdm
+
+from utilities import (
+    extract_frames,
+    write_jsonl,
+    ArticulationWriter,
+    rebuild_articulations,
+    write_unique_articulations,
+    shard_name,
+)
+
+
+def parse_example(lines):
+    # runs in a worker process, so json decoding is parallel too
+    ex_line, response_line = lines
+    ex = json.loads(ex_line)
+    old_articulations = ex.pop("articulations", None)
+    if old_articulations is not None:
+        # the first frame with each text carries its count, which
+        # extract_frames does not give
+        for frame in old_articulations:
+            frame.pop("count", None)
+    if response_line is None:
+        return ex, None, None, False
+    response = json.loads(response_line)
+    articulations = extract_frames(response)
+    return ex, response, articulations, articulations != old_articulations
+
+
+def iter_pairs(examples_path, responses_path):
+    # responses.jsonl and articulation-examples.jsonl are written line by line
+    # together, a response missing from the tail pairs with None
+    with open(examples_path, "r") as ef, open(responses_path, "r") as rf:
+        for ex_line in ef:
+            if not ex_line.endswith("\n"):
+                break
+            response_line = rf.readline()
+            if not response_line.endswith("\n"):
+                response_line = None
+            yield ex_line, response_line
+
+
+def replay_articulations(pred_path, processes, chunk_size=256, rebuild=True):
+    # re-derives every articulation prediction file from the stored responses,
+    # writing to a side directory first so the inputs stay intact until done;
+    # with rebuild the counts of a straight run are added back, shards are
+    # left without them for merge.py
+    replay_path = pred_path + ".replay"
+    if os.path.exists(replay_path):
+        shutil.rmtree(replay_path)
+    os.makedirs(replay_path)
+    writer = ArticulationWriter(replay_path, flush_every=10000)
+    missed_ids = []
+    num_changed = 0
+    pairs = iter_pairs(
+        os.path.join(pred_path, "articulation-examples.jsonl"),
+        os.path.join(pred_path, "responses.jsonl"),
+    )
+    with Pool(processes) as pool:
+        for ex, response, articulations, changed in tqdm(
+            pool.imap(parse_example, pairs, chunksize=chunk_size)
+        ):
+            if response is None:
+                missed_ids.append(ex["id"])
+                continue
+            writer.write(ex, response, articulations)
+            num_changed += changed
+    writer.close()
+    if rebuild:
+        rebuild_articulations([replay_path], replay_path)
+    num_unique = write_unique_articulations(
+        writer.paths["full"], os.path.join(replay_path, "articulations-unique.jsonl")
+    )
+    write_jsonl(
+        [{"id": ex_id} for ex_id in missed_ids],
+        os.path.join(replay_path, "replay-misses.jsonl"),
+    )
+    for name in os.listdir(replay_path):
+        os.replace(os.path.join(replay_path, name), os.path.join(pred_path, name))
+    os.rmdir(replay_path)
+    print(f"Replayed {writer.num_examples} examples")
+    print(f"Changed articulations for {num_changed} examples")
+    print(f"Missing responses for {len(missed_ids)} examples")
+    print(f"Found {writer.num_frames} frames")
+    print(f"Found {num_unique} unique frames")
+
+
+if __name__ == "__main__":
+    # regenerates articulation predictions after a change to extract_frames,
+    # from responses.jsonl only; relations depend on earlier answers, so they
+    # are replayed from the response cache with relations.py --api replay
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--model", type=str)
+    arg_parser.add_argument("--method", type=str)
+    arg_parser.add_argument(
+        "--split",
+        type=str,
+        default="test",
+    )
+    arg_parser.add_argument(
+        "--art_path", type=str, default="/shared/aifiles/disk1/media/artifacts"
+    )
+    arg_parser.add_argument("--num_shards", type=int, default=1)
+    arg_parser.add_argument("--processes", type=int, default=os.cpu_count())
+
+    args = arg_parser.parse_args()
+
+    pred_path = os.path.join(
+        args.art_path,
+        f"{args.model}-{args.method}-{args.split}",
+        "articulations",
+        "predictions",
+    )
+    if args.num_shards > 1:
+        # merge.py has to be rerun afterwards
+        for shard in range(args.num_shards):
+            replay_articulations(
+                os.path.join(pred_path, shard_name(shard, args.num_shards)),
+                args.processes,
+                rebuild=False,
+            )
+    else:
+        replay_articulations(pred_path, args.processes)
@@ -0,0 +1,206 @@
+import threading
+import time
+
+import requests
+
+from api import ChatAPI, FastChatAPI
+from cache import ResponseCache
+from ratelimit import RateLimiter, is_retryable
+
+
+class NoHealthyEndpoint(Exception):
+    pass
+
+
+class Endpoint:
+    def __init__(self, base_api, api):
+        self.base_api = base_api
+        self.api = api
+        self.outstanding = 0
+        # exponentially weighted moving average of call latency in seconds
+        self.latency = None
+        self.failures = 0
+        self.ejected = False
+        self.requests = 0
+        self.errors = 0
+        self.ejections = 0
+
+
+class RouterAPI(ChatAPI):
+    # spreads requests over several OpenAI-compatible endpoints serving the
+    # same model, behind one cache; endpoints that keep failing are ejected
+    # until their /models health check answers again
+    def __init__(
+        self,
+        model: str,
+        endpoints: list,
+        api_cls=FastChatAPI,
+        policy: str = "least_outstanding",
+        temperature: float = 0,
+        max_tokens: int = 512,
+        api_key: str = None,
+        rate_limiter: RateLimiter = None,
+        max_retries: int = 8,
+        cache: ResponseCache = None,
+        legacy_cache: ResponseCache = None,
+        stream: bool = False,
+        eject_after: int = 3,
+        health_interval: float = 10,
+        latency_decay: float = 0.8,
+    ):
+        super().__init__(
+            api_key,
+            None,
+            rate_limiter,
+            max_retries,
+            backoff_seconds=1,
+            cache=cache,
+            legacy_cache=legacy_cache,
+        )
+        if policy not in ["least_outstanding", "latency"]:
+            raise ValueError(f"Unknown routing policy: {policy}")
+        self.api_cls = api_cls
+        # cache keys are shared with direct runs of the routed backend
+        self.backend = api_cls.backend
+        self.model = model
+        self.api_model = api_cls.resolve_model(model)
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.policy = policy
+        self.eject_after = eject_after
+        self.health_interval = health_interval
+        self.latency_decay = latency_decay
+        self.endpoints = []
+        for base_api in endpoints:
+            # requests are paced by the router's limiter, so the endpoints get
+            # an unlimited one instead of the default derived from delay_seconds
+            api = api_cls(
+                model=model,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                api_key=api_key,
+                base_api=base_api,
+                rate_limiter=RateLimiter(),
+                stream=stream,
+            )
+            self.endpoints.append(Endpoint(base_api, api))
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        for endpoint in self.endpoints:
+            if not self.healthy(endpoint):
+                self.eject(endpoint)
+        self.health_thread = threading.Thread(target=self.check_health, daemon=True)
+        self.health_thread.start()
+
+    def healthy(self, endpoint):
+        try:
+            response = requests.get(
+                endpoint.base_api.rstrip("/") + "/models",
+                headers={"Authorization": f"Bearer {endpoint.api.api_key}"},
+                timeout=5,
+            )
+            return response.status_code == 200
+        except requests.RequestException:
+            return False
+
+    def eject(self, endpoint):
+        with self.lock:
+            if endpoint.ejected:
+                return
+            endpoint.ejected = True
+            endpoint.ejections += 1
+        print(f"Ejected endpoint {endpoint.base_api}")
+
+    def check_health(self):
+        while not self.closed.wait(self.health_interval):
+            for endpoint in self.endpoints:
+                if endpoint.ejected and self.healthy(endpoint):
+                    with self.lock:
+                        endpoint.ejected = False
+                        endpoint.failures = 0
+                    print(f"Restored endpoint {endpoint.base_api}")
+
+    def score(self, endpoint):
+        if self.policy == "latency":
+            # expected time to finish, unmeasured endpoints are tried first;
+            # ties, such as between unmeasured endpoints, go to the least busy
+            return (
+                (endpoint.latency or 0.0) * (endpoint.outstanding + 1),
+                endpoint.outstanding,
+            )
+        return endpoint.outstanding
+
+    def acquire_endpoint(self, tried):
+        with self.lock:
+            candidates = [
+                e for e in self.endpoints if not e.ejected and e not in tried
+            ]
+            if not candidates:
+                return None
+            endpoint = min(candidates, key=self.score)
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release_endpoint(self, endpoint, latency=None, error=None):
+        eject = False
+        with self.lock:
+            endpoint.outstanding -= 1
+            if error is not None:
+                endpoint.errors += 1
+                endpoint.failures += 1
+                eject = endpoint.failures >= self.eject_after
+            elif latency is not None:
+                endpoint.failures = 0
+                if endpoint.latency is None:
+                    endpoint.latency = latency
+                else:
+                    endpoint.latency = (
+                        self.latency_decay * endpoint.latency
+                        + (1 - self.latency_decay) * latency
+                    )
+        if eject:
+            self.eject(endpoint)
+
+    def create(self, messages, stop_when=None):
+        # a failing endpoint is skipped straight away for another healthy one,
+        # backoff in complete only starts once every endpoint has failed
+        tried = []
+        error = None
+        while True:
+            endpoint = self.acquire_endpoint(tried)
+            if endpoint is None:
+                if error is not None:
+                    raise error
+                raise NoHealthyEndpoint("No healthy endpoints")
+            tried.append(endpoint)
+            start = time.perf_counter()
+            try:
+                response = endpoint.api.create(messages, stop_when)
+            except Exception as e:
+                if not is_retryable(e):
+                    # the request itself is bad, another endpoint will not help
+                    self.release_endpoint(endpoint)
+                    raise
+                self.release_endpoint(endpoint, error=e)
+                error = e
+                continue
+            self.release_endpoint(endpoint, latency=time.perf_counter() - start)
+            return response
+
+    def build_message(self, text: str):
+        return self.api_cls.build_message(self, text)
+
+    def process_response(self, response):
+        return self.api_cls.process_response(self, response)
+
+    def close(self):
+        self.closed.set()
+        for endpoint in self.endpoints:
+            latency = "-" if endpoint.latency is None else f"{endpoint.latency:.2f}s"
+            print(
+                f"{endpoint.base_api}: {endpoint.requests} requests, "
+                f"{endpoint.errors} errors, {endpoint.ejections} ejections, "
+                f"latency {latency}"
+            )
+        super().close()
@@ -1,83 +1,554 @@
 import re
+import bz2
+import gzip
+import lzma
+from hashlib import sha1
 from textwrap import wrap
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 import networkx as nx
+import numpy as np
 import os
+import pandas as pd
+import shutil
 
 import ujson as json
 
-from api import OpenAIAPI, ReplicateAPI, DeepInfraAPI, FastChatAPI
+from api import OpenAIAPI, ReplicateAPI, DeepInfraAPI, FastChatAPI, ReplayAPI
+from async_api import AsyncOpenAIAPI, AsyncDeepInfraAPI, AsyncFastChatAPI
+from cache import build_cache
+from mock_api import MockAPI
+from router import RouterAPI
+from ratelimit import RateLimiter
+
+
+API_CLASSES = {
+    "openai": OpenAIAPI,
+    "deepinfra": DeepInfraAPI,
+    "fastchat": FastChatAPI,
+    "mock": MockAPI,
+    "replicate": ReplicateAPI,
+}
+ASYNC_API_CLASSES = {
+    "openai": AsyncOpenAIAPI,
+    "deepinfra": AsyncDeepInfraAPI,
+    "fastchat": AsyncFastChatAPI,
+}
+
+def build_rate_limiter(args, delay_seconds):
+    # --rpm/--tpm override the per-backend default of one request per delay
+    rpm = args.rpm if args.rpm is not None else 60 / delay_seconds
+    return RateLimiter(rpm=rpm, tpm=args.tpm)
+
+
+def build_response_cache(args, artifacts_path, backend):
+    # per-run cache location, used before --cache_dir existed
+    if args.cache == "sqlite":
+        run_cache_path = os.path.join(artifacts_path, f"{backend}-cache.db")
+    else:
+        run_cache_path = os.path.join(artifacts_path, f"{backend}-cache")
+    if args.cache_dir is None:
+        cache = build_cache(args.cache, run_cache_path)
+        return cache, cache
+    # shared cache across splits, methods, stages and backends, since the key
+    # already includes the backend and model parameters
+    if args.cache == "sqlite":
+        cache = build_cache("sqlite", os.path.join(args.cache_dir, "responses.db"))
+    else:
+        cache = build_cache("file", os.path.join(args.cache_dir, "responses"))
+    legacy_cache = None
+    if os.path.exists(run_cache_path):
+        legacy_cache = build_cache(args.cache, run_cache_path)
+    return cache, legacy_cache
 
 
 def build_api(args, artifacts_path):
+    if args.api == "replay":
+        # cached responses of --replay_api only, nothing is sent
+        if args.replay_api not in API_CLASSES:
+            raise ValueError(f"Unknown replay api: {args.replay_api}")
+        cache, legacy_cache = build_response_cache(
+            args, artifacts_path, args.replay_api
+        )
+        return ReplayAPI(
+            API_CLASSES[args.replay_api],
+            model=args.model,
+            temperature=args.temperature,
+            max_tokens=args.max_tokens,
+            cache=cache,
+            legacy_cache=legacy_cache,
+        )
+    if args.api == "router":
+        # one shared cache in front of every endpoint of --router_api
+        if args.router_api not in ["openai", "deepinfra", "fastchat"]:
+            raise ValueError(f"Cannot route api: {args.router_api}")
+        if not args.endpoints:
+            raise ValueError("--api router needs --endpoints, a comma-separated list")
+        cache, legacy_cache = build_response_cache(
+            args, artifacts_path, args.router_api
+        )
+        return RouterAPI(
+            model=args.model,
+            endpoints=args.endpoints.split(","),
+            api_cls=API_CLASSES[args.router_api],
+            policy=args.route,
+            temperature=args.temperature,
+            max_tokens=args.max_tokens,
+            api_key=args.api_key,
+            rate_limiter=RateLimiter(rpm=args.rpm, tpm=args.tpm),
+            max_retries=args.max_retries,
+            cache=cache,
+            legacy_cache=legacy_cache,
+            stream=args.stream,
+        )
+    cache, legacy_cache = build_response_cache(args, artifacts_path, args.api)
+    api_classes = API_CLASSES
+    transport = {}
+    if args.transport == "async":
+        # same backends and cache keys, sent from one event loop thread
+        if args.api not in ASYNC_API_CLASSES:
+            raise ValueError(f"No async transport for api: {args.api}")
+        api_classes = ASYNC_API_CLASSES
+        transport = {
+            "max_connections": args.max_connections,
+            "max_keepalive": args.max_keepalive,
+        }
     if args.api == "openai":
-        cache_path = os.path.join(artifacts_path, "openai-cache")
-        os.makedirs(cache_path, exist_ok=True)
-        api = OpenAIAPI(
+        api = api_classes["openai"](
             model=args.model,
             temperature=args.temperature,
             max_tokens=args.max_tokens,
             delay_seconds=6,
             api_key=args.api_key,
-            cache_path=cache_path,
+            base_api=args.base_api,
+            rate_limiter=build_rate_limiter(args, 6),
+            max_retries=args.max_retries,
+            cache=cache,
+            legacy_cache=legacy_cache,
+            stream=args.stream,
+            **transport,
         )
     elif args.api == "deepinfra":
-        cache_path = os.path.join(artifacts_path, "deepinfra-cache")
-        os.makedirs(cache_path, exist_ok=True)
-        api = DeepInfraAPI(
+        api = api_classes["deepinfra"](
             model=args.model,
             temperature=args.temperature,
             max_tokens=args.max_tokens,
             delay_seconds=6,
             api_key=args.api_key,
-            cache_path=cache_path,
+            rate_limiter=build_rate_limiter(args, 6),
+            max_retries=args.max_retries,
+            cache=cache,
+            legacy_cache=legacy_cache,
+            stream=args.stream,
+            **transport,
         )
     elif args.api == "fastchat":
-        cache_path = os.path.join(artifacts_path, "fastchat-cache")
-        os.makedirs(cache_path, exist_ok=True)
-        api = FastChatAPI(
+        api = api_classes["fastchat"](
             model=args.model,
             temperature=args.temperature,
             max_tokens=args.max_tokens,
             delay_seconds=1,
             api_key=args.api_key,
-            cache_path=cache_path,
+            rate_limiter=build_rate_limiter(args, 1),
+            max_retries=args.max_retries,
+            cache=cache,
+            legacy_cache=legacy_cache,
+            stream=args.stream,
+            **transport,
+        )
+    elif args.api == "mock":
+        api = MockAPI(
+            model=args.model,
+            temperature=args.temperature,
+            max_tokens=args.max_tokens,
+            latency=args.mock_latency,
+            latency_dist=args.mock_latency_dist,
+            error_rate=args.mock_error_rate,
+            provider_rpm=args.mock_rpm,
+            rate_limiter=RateLimiter(rpm=args.rpm, tpm=args.tpm),
+            max_retries=args.max_retries,
+            cache=cache,
+            legacy_cache=legacy_cache,
         )
     elif args.api == "replicate":
-        cache_path = os.path.join(artifacts_path, "replicate-cache")
-        os.makedirs(cache_path, exist_ok=True)
         api = ReplicateAPI(
             model=args.model,
             temperature=args.temperature,
             max_tokens=args.max_tokens,
             delay_seconds=6,
             api_key=args.api_key,
-            cache_path=cache_path,
+            rate_limiter=build_rate_limiter(args, 6),
+            max_retries=args.max_retries,
+            cache=cache,
+            legacy_cache=legacy_cache,
+            pipeline=args.replicate_pipeline,
+            max_inflight=args.max_inflight,
+            deadline_seconds=args.deadline,
         )
     else:
         raise ValueError(f"Unknown api: {args.api}")
     return api
 
 
-def read_jsonl(path):
-    examples = []
-    with open(path, "r") as f:
+def send_all(api, requests, workers=1, stop_when=None):
+    # requests yields (item, messages) pairs, responses come back as
+    # (item, response) in the same order, with at most 2 * workers in flight;
+    # identical requests already in flight share one call
+    if getattr(api, "is_async", False):
+        # requests run as tasks on the api's event loop, no worker threads, so
+        # the window is sized to what the api itself keeps in flight
+        workers = max(workers, api.max_inflight)
+        yield from send_ordered(api.submit, api, requests, workers, stop_when)
+        return
+    if workers <= 1:
+        for item, messages in requests:
+            yield item, api.send(messages, stop_when)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from send_ordered(
+            partial(executor.submit, api.send), api, requests, workers, stop_when
+        )
+
+
+def send_ordered(submit, api, requests, workers, stop_when=None):
+    # submit(messages, stop_when) returns a future; results are yielded in
+    # request order with at most 2 * workers submitted at once
+    pending = deque()
+    inflight = {}
+    for item, messages in requests:
+        key = api.cache_key(messages)
+        if key not in inflight or inflight[key].done():
+            inflight[key] = submit(messages, stop_when)
+        pending.append((item, key, inflight[key]))
+        if len(pending) >= 2 * workers:
+            item, key, future = pending.popleft()
+            result = future.result()
+            # finished requests are left to the cache, so inflight stays as
+            # small as the window
+            if inflight.get(key) is future:
+                del inflight[key]
+            yield item, result
+    while pending:
+        item, key, future = pending.popleft()
+        result = future.result()
+        if inflight.get(key) is future:
+            del inflight[key]
+        yield item, result
+
+
+def open_text(path, mode="r"):
+    # compression is detected from magic bytes when reading and from the
+    # extension when writing, so .jsonl.gz/.bz2/.xz/.zst dumps work transparently
+    if "r" in mode:
+        with open(path, "rb") as f:
+            magic = f.read(6)
+        if magic.startswith(b"\x1f\x8b"):
+            kind = "gz"
+        elif magic.startswith(b"BZh"):
+            kind = "bz2"
+        elif magic.startswith(b"\xfd7zXZ\x00"):
+            kind = "xz"
+        elif magic.startswith(b"\x28\xb5\x2f\xfd"):
+            kind = "zst"
+        else:
+            kind = None
+    else:
+        kind = path.rsplit(".", 1)[-1]
+    if kind == "gz":
+        return gzip.open(path, mode + "t")
+    elif kind == "bz2":
+        return bz2.open(path, mode + "t")
+    elif kind == "xz":
+        return lzma.open(path, mode + "t")
+    elif kind == "zst":
+        import zstandard
+
+        return zstandard.open(path, mode + "t")
+    return open(path, mode)
+
+
+def iter_jsonl(path, fields=None, stats=None):
+    # streams records, optionally keeping only the given fields, and reports
+    # malformed lines once at the end instead of printing each one
+    num_lines = 0
+    num_errors = 0
+    with open_text(path, "r") as f:
         for line in f:
             line = line.strip()
-            if line:
-                try:
-                    ex = json.loads(line)
-                    examples.append(ex)
-                except Exception as e:
-                    print(e)
-    return examples
+            if not line:
+                continue
+            num_lines += 1
+            try:
+                ex = json.loads(line)
+            except Exception:
+                num_errors += 1
+                continue
+            if fields is not None:
+                ex = {k: ex[k] for k in fields if k in ex}
+            yield ex
+    if stats is not None:
+        stats["lines"] = num_lines
+        stats["errors"] = num_errors
+    if num_errors > 0:
+        print(f"Skipped {num_errors} of {num_lines} malformed lines in {path}")
+
+
+def read_jsonl(path, fields=None):
+    return list(iter_jsonl(path, fields))
+
+
+class JsonlWriter:
+    def __init__(self, path, mode="w", buffer_size=1000):
+        self.f = open_text(path, mode)
+        self.buffer_size = buffer_size
+        self.buffer = []
+
+    def write(self, example):
+        self.buffer.append(json.dumps(example))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.f.write("\n".join(self.buffer) + "\n")
+            self.buffer = []
+        self.f.flush()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 def write_jsonl(data, path):
-    with open(path, "w") as f:
+    with JsonlWriter(path) as writer:
         for example in data:
-            json_data = json.dumps(example)
-            f.write(json_data + "\n")
+            writer.write(example)
+
+
+def shard_of(ex_id, num_shards):
+    # stable across machines and python processes, unlike hash()
+    return int(sha1(str(ex_id).encode()).hexdigest()[:8], 16) % num_shards
+
+
+def shard_name(shard, num_shards):
+    return f"shard-{shard}-of-{num_shards}"
+
+
+def truncate_jsonl(path, num_lines):
+    # drop everything after the first num_lines lines, including a partial tail
+    if not os.path.exists(path):
+        open(path, "w").close()
+        return
+    with open(path, "rb+") as f:
+        for _ in range(num_lines):
+            if not f.readline():
+                break
+        f.truncate(f.tell())
+
+
+ARTICULATION_FILES = {
+    "responses": "responses.jsonl",
+    "full": "articulations-full.jsonl",
+    "examples": "articulation-examples.jsonl",
+    "annotations": "articulation-annotations.jsonl",
+}
+
+
+class ArticulationWriter:
+    # appends each articulated example to the prediction files as it completes,
+    # the annotation line is written last and marks the example as done; the
+    # annotation lines are held back until the other files are flushed, so on
+    # disk they never get ahead of the lines they vouch for
+    def __init__(self, pred_path, resume=False, flush_every=100):
+        self.pred_path = pred_path
+        self.flush_every = flush_every
+        self.paths = {
+            k: os.path.join(pred_path, name) for k, name in ARTICULATION_FILES.items()
+        }
+        finish_rebuild(pred_path)
+        self.done_ids = set()
+        self.num_examples = 0
+        self.num_frames = 0
+        self.pending_annotations = []
+        if resume:
+            self.resume()
+        mode = "a" if resume else "w"
+        self.files = {k: open(p, mode) for k, p in self.paths.items()}
+
+    def resume(self):
+        if not os.path.exists(self.paths["annotations"]):
+            return
+        with open(self.paths["annotations"], "r") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                try:
+                    ann = json.loads(line)
+                except Exception:
+                    break
+                self.done_ids.add(ann["id"])
+                self.num_examples += 1
+                self.num_frames += len(ann["articulations"])
+        for k in ["responses", "examples", "annotations"]:
+            truncate_jsonl(self.paths[k], self.num_examples)
+        truncate_jsonl(self.paths["full"], self.num_frames)
+
+    def write(self, ex, response, articulations):
+        ex["articulations"] = articulations
+        self.files["responses"].write(json.dumps(response) + "\n")
+        for frame in articulations:
+            self.files["full"].write(json.dumps(frame) + "\n")
+        self.files["examples"].write(json.dumps(ex) + "\n")
+        ann = {"id": ex["id"], "articulations": articulations}
+        self.pending_annotations.append(json.dumps(ann) + "\n")
+        self.done_ids.add(ex["id"])
+        self.num_examples += 1
+        self.num_frames += len(articulations)
+        if self.num_examples % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        for k in ["responses", "full", "examples"]:
+            self.files[k].flush()
+        self.files["annotations"].write("".join(self.pending_annotations))
+        self.files["annotations"].flush()
+        self.pending_annotations = []
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+
+
+def write_unique_articulations(full_path, unique_path):
+    # first-seen order with duplicate counts, streamed from the full frame file
+    dup_count = defaultdict(int)
+    with open(full_path, "r") as f:
+        for line in f:
+            dup_count[json.loads(line)["text"]] += 1
+    seen = set()
+    with open(full_path, "r") as f, open(unique_path, "w") as uf:
+        for line in f:
+            frame = json.loads(line)
+            if frame["text"] in seen:
+                continue
+            seen.add(frame["text"])
+            frame["count"] = dup_count[frame["text"]]
+            uf.write(json.dumps(frame) + "\n")
+    return len(seen)
+
+
+def index_articulations(pred_path):
+    # opens the articulation files of a run and finds the lines of every
+    # example by id: their byte offsets, in ARTICULATION_FILES order, and the
+    # number of frames, with ids in file order
+    files = {
+        k: open(os.path.join(pred_path, name), "rb")
+        for k, name in ARTICULATION_FILES.items()
+    }
+    locations = {}
+    while True:
+        offsets = tuple(f.tell() for f in files.values())
+        ann_line = files["annotations"].readline()
+        if not ann_line.endswith(b"\n"):
+            break
+        ann = json.loads(ann_line)
+        files["responses"].readline()
+        files["examples"].readline()
+        for _ in ann["articulations"]:
+            files["full"].readline()
+        locations[ann["id"]] = (offsets, len(ann["articulations"]))
+    return files, locations
+
+
+def rebuild_articulations(sources, pred_path, ids=None):
+    # writes the articulation files of pred_path from those of the source runs
+    # as one straight pass over the data writes them: examples in the order of
+    # ids, by default the file order of the first source, and the first frame
+    # with each text carrying how many frames have that text; the files are
+    # written to a side directory and moved in by finish_rebuild
+    indexed = [index_articulations(source) for source in sources]
+    where = {}
+    for files, locations in indexed:
+        for ex_id, (offsets, num_frames) in locations.items():
+            where[ex_id] = (files, offsets, num_frames)
+    if ids is None:
+        ids = list(indexed[0][1])
+    for ex_id in ids:
+        if ex_id not in where:
+            raise ValueError(f"No articulations for example {ex_id}, is it finished?")
+
+    def seek(files, offsets):
+        for f, offset in zip(files.values(), offsets):
+            f.seek(offset)
+
+    dup_count = defaultdict(int)
+    for ex_id in ids:
+        files, offsets, num_frames = where[ex_id]
+        seek(files, offsets)
+        for _ in range(num_frames):
+            dup_count[json.loads(files["full"].readline())["text"]] += 1
+
+    rebuild_path = pred_path + ".rebuild"
+    if os.path.exists(rebuild_path):
+        shutil.rmtree(rebuild_path)
+    os.makedirs(rebuild_path)
+    outputs = {
+        k: open(os.path.join(rebuild_path, name), "w")
+        for k, name in ARTICULATION_FILES.items()
+    }
+    seen = set()
+    num_frames_total = 0
+    for ex_id in ids:
+        files, offsets, num_frames = where[ex_id]
+        seek(files, offsets)
+        outputs["responses"].write(files["responses"].readline().decode())
+        ex = json.loads(files["examples"].readline())
+        ann = json.loads(files["annotations"].readline())
+        for f_idx in range(num_frames):
+            frame = json.loads(files["full"].readline())
+            # the three copies of the frame, as one object they shared the count
+            copies = [frame, ex["articulations"][f_idx], ann["articulations"][f_idx]]
+            for c in copies:
+                c.pop("count", None)
+            if frame["text"] not in seen:
+                seen.add(frame["text"])
+                for c in copies:
+                    c["count"] = dup_count[frame["text"]]
+            outputs["full"].write(json.dumps(frame) + "\n")
+        outputs["examples"].write(json.dumps(ex) + "\n")
+        outputs["annotations"].write(json.dumps(ann) + "\n")
+        num_frames_total += num_frames
+    for files, _ in indexed:
+        for f in files.values():
+            f.close()
+    for f in outputs.values():
+        f.close()
+    open(os.path.join(rebuild_path, "done"), "w").close()
+    finish_rebuild(pred_path)
+    return len(ids), num_frames_total
+
+
+def finish_rebuild(pred_path):
+    # moves in the files of a finished rebuild, also after a crash halfway
+    # through, and drops an unfinished one, which left pred_path untouched
+    rebuild_path = pred_path + ".rebuild"
+    if not os.path.exists(rebuild_path):
+        return
+    if os.path.exists(os.path.join(rebuild_path, "done")):
+        for name in ARTICULATION_FILES.values():
+            if os.path.exists(os.path.join(rebuild_path, name)):
+                os.replace(
+                    os.path.join(rebuild_path, name), os.path.join(pred_path, name)
+                )
+    shutil.rmtree(rebuild_path)
 
 
 def format_prompt(text):
@@ -123,9 +594,67 @@ def extract_frames(message):
     return found_frames
 
 
+ARTICULATION_LINE = re.compile(r"^\d+\.[ab]:")
+RELATION_LINE = re.compile(r"^[ab]:")
+RELATION_ANSWER = re.compile(r"^b:\s*\w+\(\s*\d+\s*,\s*\d+\s*\)$")
+
+
+def answer_end(text, line_pattern, final_pattern=None, prefix_chars=8):
+    # offset where a streamed structured answer ends, or None while it may
+    # still continue: the answer is over at the first line that is not part of
+    # the format, known once prefix_chars of it arrived, or right after a line
+    # matching final_pattern
+    end = 0
+    answered = False
+    for line in text.splitlines(keepends=True):
+        stripped = line.strip()
+        if final_pattern is not None and final_pattern.match(stripped):
+            return end + len(line.rstrip("\n"))
+        finished = line.endswith("\n")
+        if stripped and (finished or len(stripped) >= prefix_chars):
+            if not line_pattern.match(stripped):
+                # trailing commentary would make the whole answer unparseable
+                return end if answered else None
+            answered = True
+        if not finished:
+            return None
+        end += len(line)
+    return None
+
+
+def articulation_complete(text):
+    return answer_end(text, ARTICULATION_LINE)
+
+
+def relation_complete(text):
+    return answer_end(text, RELATION_LINE, RELATION_ANSWER)
+
+
+def batch_relation_complete(text):
+    return answer_end(text, ARTICULATION_LINE)
+
+
+def parse_relation(content, reasoning, f_map):
+    # Paraphrases(X,Y)
+    # Specializes(X,Y)
+    # Contradicts(X,Y)
+    rt, c = content.split("(")
+    rt = rt.lower()
+    x, y = c[:-1].split(",")
+    return {
+        "type": rt,
+        "x": f_map[int(x)],
+        "y": f_map[int(y)],
+        "reasoning": reasoning,
+    }
+
+
 def extract_relations(response, f_map):
-    content = response["content"]
     relations = []
+    if response is None:
+        # missing from a replayed cache
+        return relations
+    content = response["content"]
     try:
         reasoning = None
         for line in content.split("\n"):
@@ -137,25 +666,41 @@ def extract_relations(response, f_map):
             if mt == "a":
                 reasoning = content
             if mt == "b":
-                # Paraphrases(X,Y)
-                # Specializes(X,Y)
-                # Contradicts(X,Y)
-                rt, c = content.split("(")
-                rt = rt.lower()
-                x, y = c[:-1].split(",")
-                relations.append(
-                    {
-                        "type": rt,
-                        "x": f_map[int(x)],
-                        "y": f_map[int(y)],
-                        "reasoning": reasoning,
-                    }
-                )
+                relations.append(parse_relation(content, reasoning, f_map))
     except Exception as e:
         pass
     return relations
 
 
+def extract_batch_relations(response, f_maps):
+    # answers to batched prompts prefix each line with the group number,
+    # 1.a: ... 1.b: Relation(x,y) 2.a: ..., and map through that group's f_map
+    relations = [[] for _ in f_maps]
+    if response is None:
+        return relations
+    content = response["content"]
+    reasoning = {}
+    for line in content.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            m_id = line.split(":")[0]
+            g_id, mt = m_id.split(".")
+            g_idx = int(g_id) - 1
+            content = line[len(m_id) + 1 :].strip()
+            if mt == "a":
+                reasoning[g_idx] = content
+            if mt == "b":
+                relations[g_idx].append(
+                    parse_relation(content, reasoning.get(g_idx), f_maps[g_idx])
+                )
+        except Exception as e:
+            # a malformed line only loses that group's answer
+            continue
+    return relations
+
+
 def rel_order(rel):
     if rel["type"] == "paraphrases":
         return -1
@@ -175,64 +720,111 @@ def format_reasoning(r):
     return r.strip()
 
 
-def extract_problems(frame):
-    r = frame["reasoning"].lower()
-    pairs = []
-    if "confidence" in r:
-        pairs.append("confidence")
-    if "conspiracy" in r:
-        pairs.append("conspiracy")
-    if "complacency" in r:
-        pairs.append("complacency")
-    if "calculation" in r:
-        pairs.append("calculation")
-    if "collective" in r:
-        pairs.append("collective")
-    if "compliance" in r:
-        pairs.append("compliance")
-    if "constraints" in r:
-        pairs.append("constraints")
-    if len(pairs) == 0:
-        pairs.append("other")
-    return pairs
-
-
-def count_problems(frames):
-    counts = defaultdict(int)
-    all_pairs = set()
-    for frame in frames:
-        r = frame["reasoning"].lower()
-        pairs = []
-        if "confidence" in r:
-            counts["Confidence"] += 1
-            pairs.append("Confidence")
-        if "conspiracy" in r:
-            counts["Conspiracy"] += 1
-            pairs.append("Conspiracy")
-        if "complacency" in r:
-            counts["Complacency"] += 1
-            pairs.append("Complacency")
-        if "calculation" in r:
-            counts["Calculation"] += 1
-            pairs.append("Calculation")
-        if "collective" in r:
-            counts["Collective"] += 1
-            pairs.append("Collective")
-        if "compliance" in r:
-            counts["Compliance"] += 1
-            pairs.append("Compliance")
-        if "constraints" in r:
-            counts["Constraints"] += 1
-            pairs.append("Constraints")
-        if len(pairs) == 0:
-            pairs.append("Other")
-            counts["Other"] += 1
-            print(frame["reasoning"])
-        all_pairs.add(tuple(pairs))
-    for c, count in counts.items():
-        print(f"{c}: {count} ({100*count/len(frames):.0f}%)")
-
-    print(all_pairs)
+# vaccine hesitancy problems and the keywords that tag a reasoning with them
+PROBLEM_TAXONOMY = {
+    "confidence": ["confidence"],
+    "conspiracy": ["conspiracy"],
+    "complacency": ["complacency"],
+    "calculation": ["calculation"],
+    "collective": ["collective"],
+    "compliance": ["compliance"],
+    "constraints": ["constraints"],
+}
+
+
+class ProblemTagger:
+    # tags frames with the problems whose keywords occur anywhere in their
+    # lowercased reasoning, using one compiled pattern per problem so that
+    # keywords overlapping or contained in one another are all found, as with
+    # a substring test per keyword; frames without any problem are tagged "other"
+    def __init__(self, taxonomy=None):
+        if taxonomy is None:
+            taxonomy = PROBLEM_TAXONOMY
+        self.problems = list(taxonomy) + ["other"]
+        self.patterns = []
+        for keywords in taxonomy.values():
+            if len(keywords) == 0:
+                self.patterns.append(None)
+                continue
+            self.patterns.append(
+                re.compile("|".join(re.escape(k.lower()) for k in keywords))
+            )
+
+    def tag_indices(self, reasoning):
+        reasoning = reasoning.lower()
+        p_idxs = [
+            p_idx
+            for p_idx, pattern in enumerate(self.patterns)
+            if pattern is not None and pattern.search(reasoning)
+        ]
+        if len(p_idxs) == 0:
+            return [len(self.problems) - 1]
+        return p_idxs
+
+    def tag(self, frame):
+        return [self.problems[p_idx] for p_idx in self.tag_indices(frame["reasoning"])]
+
+    def tag_frames(self, frames):
+        # frames x problems boolean matrix, "other" in the last column
+        tags = np.zeros(shape=[len(frames), len(self.problems)], dtype=bool)
+        for f_idx, frame in enumerate(frames):
+            tags[f_idx, self.tag_indices(frame["reasoning"])] = True
+        return tags
+
+    def problems_of(self, frame_tags):
+        return [p for p, tagged in zip(self.problems, frame_tags) if tagged]
+
+    def report(self, tags):
+        # frames per problem, and frames per pair of problems on the diagonal
+        # and off it
+        counts = pd.DataFrame(
+            {
+                "count": tags.sum(axis=0),
+                "percent": 100 * tags.mean(axis=0) if len(tags) > 0 else 0.0,
+            },
+            index=[p.title() for p in self.problems],
+        )
+        tags = tags.astype(np.int64)
+        cooccurrence = pd.DataFrame(
+            tags.T @ tags,
+            index=counts.index,
+            columns=counts.index,
+        )
+        return counts, cooccurrence
+
+
+def load_taxonomy(path):
+    if path is None:
+        return PROBLEM_TAXONOMY
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=1)
+def default_tagger():
+    return ProblemTagger()
+
+
+def extract_problems(frame, tagger=None):
+    if tagger is None:
+        tagger = default_tagger()
+    return tagger.tag(frame)
+
+
+def count_problems(frames, tagger=None):
+    if tagger is None:
+        tagger = default_tagger()
+    counts, cooccurrence = tagger.report(tagger.tag_frames(list(frames)))
+    print_problems(counts)
+    return counts, cooccurrence
+
+
+def print_problems(counts):
+    for problem, count, percent in zip(
+        counts.index, counts["count"], counts["percent"]
+    ):
+        if count > 0:
+            print(f"{problem}: {count} ({percent:.0f}%)")
 
 
 def reduce_paraphrases(frames, relations):
@@ -360,63 +952,78 @@ def clean_reasoning(r):
     return r.strip().capitalize()
 
 
-def order_hierarchy(frames, relations, counts, max_depth=None):
-    g = nx.DiGraph()
-    ig = nx.DiGraph()
-
-    for f_idx, frame in frames.items():
-        g.add_node(f_idx)
-        ig.add_node(f_idx)
-
+def order_hierarchy(frames, relations, counts, max_depth=None, unique=False):
+    # frames depth first from the most general ones, children ordered by the
+    # total count of their subtree, largest first; with unique each frame is
+    # listed once, at its first position, instead of once per parent
+    children = {f_idx: {} for f_idx in frames}
     for edge in relations:
         if edge["type"] == "specializes":
-            g.add_edge(edge["x"], edge["y"])
-            ig.add_edge(edge["y"], edge["x"])
+            children[edge["y"]][edge["x"]] = None
+    has_parent = set()
+    for f_idx in frames:
+        has_parent.update(children[f_idx])
 
-    roots = set()
-    for n, d in g.out_degree():
-        if d == 0:
-            roots.add(n)
+    # depth first search from the roots, then from whatever is left, dropping
+    # the edges that close a cycle, as LLM specializes edges can form cycles;
+    # post order has every frame after all of its children
+    starts = [f_idx for f_idx in frames if f_idx not in has_parent]
+    starts.extend(frames)
+    dag = {}
+    on_stack = set()
+    post_order = []
+    for start in starts:
+        if start in dag:
+            continue
+        dag[start] = []
+        on_stack.add(start)
+        stack = [(start, iter(children[start]))]
+        while stack:
+            n, n_children = stack[-1]
+            for v in n_children:
+                if v in on_stack:
+                    continue
+                dag[n].append(v)
+                if v not in dag:
+                    dag[v] = []
+                    on_stack.add(v)
+                    stack.append((v, iter(children[v])))
+                    break
+            else:
+                stack.pop()
+                on_stack.remove(n)
+                post_order.append(n)
 
     r_count = {}
+    for f_idx in post_order:
+        r_count[f_idx] = counts[f_idx] + sum(r_count[v] for v in dag[f_idx])
 
-    def recursive_count(f_idx):
-        if f_idx in r_count:
-            return r_count[f_idx]
-        frame = frames[f_idx]
-        count = counts[f_idx]
-        edges = list(ig.out_edges(f_idx))
-        for idx, (_, v) in enumerate(edges):
-            if v not in r_count:
-                r_count[v] = recursive_count(v)
-            count += r_count[v]
-        return count
+    # frames without a parent once cycles are cut, in frames order
+    dag_children = set()
+    for f_idx in dag:
+        dag_children.update(dag[f_idx])
+    roots = [f_idx for f_idx in frames if f_idx not in dag_children]
 
+    # ties keep their order, frames order for roots, as sorted is stable even
+    # when reversed
+    ranked = {
+        f_idx: sorted(dag[f_idx], key=r_count.__getitem__, reverse=True)
+        for f_idx in dag
+    }
     ordered = []
-
-    def recursive_frame_print(f_idx, depth=0, last=False, prefix="", max_depth=None):
+    listed = set()
+    stack = [
+        (f_idx, 0)
+        for f_idx in reversed(sorted(roots, key=r_count.__getitem__, reverse=True))
+    ]
+    while stack:
+        f_idx, depth = stack.pop()
         if max_depth is not None and depth >= max_depth:
-            return
-        frame = frames[f_idx]
-        problems = extract_problems(frame)
-        p_str = ", ".join([p.title() for p in problems])
-        count = recursive_count(f_idx)
-        new_prefix = prefix + ("│  " if not last else "   ")
-        ordered.append((f_idx, frame))
-        edges = list(ig.out_edges(f_idx))
-        for idx, (_, v) in enumerate(
-            sorted(edges, key=lambda x: recursive_count(x[1]), reverse=True)
-        ):
-            recursive_frame_print(
-                v,
-                depth + 1,
-                last=idx == len(edges) - 1,
-                prefix=new_prefix,
-                max_depth=max_depth,
-            )
-
-    for idx, f_idx in enumerate(
-        sorted(list(roots), key=lambda x: recursive_count(x), reverse=True)
-    ):
-        recursive_frame_print(f_idx, 0, last=idx == len(roots) - 1, max_depth=max_depth)
+            continue
+        if unique:
+            if f_idx in listed:
+                continue
+            listed.add(f_idx)
+        ordered.append((f_idx, frames[f_idx]))
+        stack.extend((v, depth + 1) for v in reversed(ranked[f_idx]))
     return ordered
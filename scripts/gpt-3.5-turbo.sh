@@ -1,3 +1,4 @@
 #!/bin/bash
-python code/articulate.py --api openai --api_key $OPENAI_KEY --method few --model gpt-3.5-turbo
-python code/relations.py --api openai --api_key $OPENAI_KEY --method few --model gpt-3.5-turbo
+CACHE_DIR=${CACHE_DIR:-/shared/aifiles/disk1/media/artifacts/cache}
+python code/articulate.py --api openai --api_key $OPENAI_KEY --method few --model gpt-3.5-turbo --cache_dir $CACHE_DIR
+python code/relations.py --api openai --api_key $OPENAI_KEY --method few --model gpt-3.5-turbo --cache_dir $CACHE_DIR
@@ -1,3 +1,4 @@
 #!/bin/bash
-python code/articulate.py --api openai --api_key $OPENAI_KEY --method few --model gpt-4
-python code/relations.py --api openai --api_key $OPENAI_KEY --method few --model gpt-4
+CACHE_DIR=${CACHE_DIR:-/shared/aifiles/disk1/media/artifacts/cache}
+python code/articulate.py --api openai --api_key $OPENAI_KEY --method few --model gpt-4 --cache_dir $CACHE_DIR
+python code/relations.py --api openai --api_key $OPENAI_KEY --method few --model gpt-4 --cache_dir $CACHE_DIR
@@ -1,5 +1,6 @@
 #!/bin/bash
-python code/articulate.py --api deepinfra --api_key $DEEPINFRA_TOKEN --method few --model llama-2
-python code/relations.py --api deepinfra --api_key $DEEPINFRA_TOKEN --method few --model llama-2
-python code/articulate.py --api deepinfra --api_key $DEEPINFRA_TOKEN --method iccl --model llama-2
-python code/relations.py --api deepinfra --api_key $DEEPINFRA_TOKEN --method iccl --model llama-2
+CACHE_DIR=${CACHE_DIR:-/shared/aifiles/disk1/media/artifacts/cache}
+python code/articulate.py --api deepinfra --api_key $DEEPINFRA_TOKEN --method few --model llama-2 --cache_dir $CACHE_DIR
+python code/relations.py --api deepinfra --api_key $DEEPINFRA_TOKEN --method few --model llama-2 --cache_dir $CACHE_DIR
+python code/articulate.py --api deepinfra --api_key $DEEPINFRA_TOKEN --method iccl --model llama-2 --cache_dir $CACHE_DIR
+python code/relations.py --api deepinfra --api_key $DEEPINFRA_TOKEN --method iccl --model llama-2 --cache_dir $CACHE_DIR
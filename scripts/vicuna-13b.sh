@@ -1,5 +1,6 @@
 #!/bin/bash
-python code/articulate.py --api replicate --api_key $REPLICATE_API_TOKEN --method few --model vicuna-13b
-python code/relations.py --api replicate --api_key $REPLICATE_API_TOKEN --method few --model vicuna-13b
-python code/articulate.py --api replicate --api_key $REPLICATE_API_TOKEN --method iccl --model vicuna-13b
-python code/relations.py --api replicate --api_key $REPLICATE_API_TOKEN --method iccl --model vicuna-13b
+CACHE_DIR=${CACHE_DIR:-/shared/aifiles/disk1/media/artifacts/cache}
+python code/articulate.py --api replicate --api_key $REPLICATE_API_TOKEN --method few --model vicuna-13b --cache_dir $CACHE_DIR
+python code/relations.py --api replicate --api_key $REPLICATE_API_TOKEN --method few --model vicuna-13b --cache_dir $CACHE_DIR
+python code/articulate.py --api replicate --api_key $REPLICATE_API_TOKEN --method iccl --model vicuna-13b --cache_dir $CACHE_DIR
+python code/relations.py --api replicate --api_key $REPLICATE_API_TOKEN --method iccl --model vicuna-13b --cache_dir $CACHE_DIR
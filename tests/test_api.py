@@ -0,0 +1,140 @@
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+from api import EMPTY_ANSWER, ChatAPI, ReplicateAPI
+from cache import ResponseCache
+
+
+class SlowCache(ResponseCache):
+    # put() blocks until released, so a cancel can land while it runs
+    def __init__(self):
+        super().__init__()
+        self.entries = {}
+        self.storing = threading.Event()
+        self.release = threading.Event()
+
+    def load(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, value):
+        self.storing.set()
+        self.release.wait(5)
+        self.entries[key] = value
+
+
+class Prediction:
+    id = "p"
+    status = "succeeded"
+    error = None
+
+    def __init__(self, text):
+        self.text = text
+
+    def reload(self):
+        pass
+
+    def cancel(self):
+        pass
+
+    def __iter__(self):
+        yield "output", [self.text]
+        yield "error", None
+
+
+def build_api(cache):
+    api = ReplicateAPI(
+        model="llama-2", cache=cache, pipeline=True, poll_interval=0.01
+    )
+    api.create_prediction = lambda messages: Prediction(messages[-1]["content"])
+    return api
+
+
+def test_cancel_while_storing_keeps_pipeline_alive():
+    cache = SlowCache()
+    api = build_api(cache)
+    try:
+        first = api.submit([{"role": "user", "content": "first"}])
+        assert cache.storing.wait(5)
+        # the job is running, so a speculative cancel no longer applies
+        assert not first.cancel()
+        cache.release.set()
+        assert first.result(5)["content"] == "first"
+        second = api.submit([{"role": "user", "content": "second"}])
+        assert second.result(5)["content"] == "second"
+    finally:
+        api.close()
+
+
+def test_cancelled_before_start_is_never_sent():
+    cache = SlowCache()
+    cache.release.set()
+    api = build_api(cache)
+    sent = []
+    create = api.create_prediction
+    api.create_prediction = lambda messages: sent.append(messages) or create(messages)
+    try:
+        # queue both before the pipeline thread starts
+        api.pipeline_thread = True
+        cancelled = api.submit([{"role": "user", "content": "cancelled"}])
+        assert cancelled.cancel()
+        kept = api.submit([{"role": "user", "content": "kept"}])
+        api.pipeline_thread = threading.Thread(target=api.run_pipeline, daemon=True)
+        api.pipeline_thread.start()
+        assert kept.result(5)["content"] == "kept"
+        assert [m[-1]["content"] for m in sent] == ["kept"]
+    finally:
+        api.close()
+
+
+def test_resolve_ignores_settled_futures():
+    future = Future()
+    future.cancel()
+    ReplicateAPI.resolve(future, {"content": "late"})
+    ReplicateAPI.resolve(future, error=RuntimeError("late"))
+    assert future.cancelled()
+
+
+class StatusError(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class FailingAPI(ChatAPI):
+    backend = "failing"
+    api_model = "m"
+    temperature = 0
+    max_tokens = 8
+
+    def __init__(self, error, cache):
+        super().__init__(cache=cache, max_retries=0)
+        self.error = error
+
+    def create(self, messages, stop_when=None):
+        raise self.error
+
+    def build_message(self, text):
+        return {"role": "user", "content": text}
+
+    def process_response(self, response):
+        return response
+
+
+def test_rejected_request_gives_empty_answer():
+    cache = SlowCache()
+    cache.release.set()
+    api = FailingAPI(StatusError("maximum context length exceeded", 400), cache)
+    answer = api.send([{"role": "user", "content": "long"}])
+    assert answer == EMPTY_ANSWER
+    assert cache.entries == {}
+    assert sum(api.metrics.failures.values()) == 1
+
+
+def test_config_error_stops_the_run():
+    cache = SlowCache()
+    cache.release.set()
+    api = FailingAPI(StatusError("Incorrect API key provided", 401), cache)
+    with pytest.raises(StatusError):
+        api.send([{"role": "user", "content": "hi"}])
@@ -0,0 +1,129 @@
+import os
+from collections import defaultdict
+
+from utilities import (
+    ARTICULATION_FILES,
+    ArticulationWriter,
+    extract_frames,
+    finish_rebuild,
+    rebuild_articulations,
+    write_jsonl,
+    write_unique_articulations,
+)
+
+
+def build_data(num_examples=40):
+    data = []
+    responses = []
+    for ex_idx in range(num_examples):
+        data.append({"id": f"ex-{ex_idx}", "text": f"tweet {ex_idx}"})
+        # frame texts repeat across examples, so counts and first occurrences
+        # depend on the order examples are written in
+        lines = []
+        for f_idx in range(ex_idx % 3 + 1):
+            lines.append(f"{f_idx + 1}.a: reasoning {ex_idx}")
+            lines.append(f"{f_idx + 1}.b: frame {(ex_idx + f_idx) % 7}")
+        responses.append({"role": "assistant", "content": "\n".join(lines)})
+    return data, responses
+
+
+def write_baseline(data, responses, pred_path):
+    # what articulate.py wrote in one pass before it streamed its output: the
+    # unique frames are the same objects as in the other files, so setting
+    # their count marks the first occurrence of each text everywhere
+    os.makedirs(pred_path)
+    all_articulations = []
+    examples = []
+    annotations = []
+    for ex, response in zip(data, responses):
+        articulations = extract_frames(response)
+        examples.append({**ex, "articulations": articulations})
+        all_articulations.extend(articulations)
+        annotations.append({"id": ex["id"], "articulations": articulations})
+    seen = set()
+    dup_count = defaultdict(int)
+    unique_articulations = []
+    for f in all_articulations:
+        dup_count[f["text"]] += 1
+        if f["text"] in seen:
+            continue
+        seen.add(f["text"])
+        unique_articulations.append(f)
+    for frame in unique_articulations:
+        frame["count"] = dup_count[frame["text"]]
+    write_jsonl(all_articulations, os.path.join(pred_path, ARTICULATION_FILES["full"]))
+    write_jsonl(
+        unique_articulations, os.path.join(pred_path, "articulations-unique.jsonl")
+    )
+    write_jsonl(examples, os.path.join(pred_path, ARTICULATION_FILES["examples"]))
+    write_jsonl(annotations, os.path.join(pred_path, ARTICULATION_FILES["annotations"]))
+    write_jsonl(responses, os.path.join(pred_path, ARTICULATION_FILES["responses"]))
+
+
+def run(data, responses, pred_path, skip=(), resume=False):
+    # one articulate.py run, leaving out the examples in skip
+    os.makedirs(pred_path, exist_ok=True)
+    writer = ArticulationWriter(pred_path, resume=resume, flush_every=4)
+    for ex, response in zip(data, responses):
+        if ex["id"] in skip or ex["id"] in writer.done_ids:
+            continue
+        writer.write(dict(ex), response, extract_frames(response))
+    writer.close()
+    ids = [ex["id"] for ex in data if ex["id"] in writer.done_ids]
+    rebuild_articulations([pred_path], pred_path, ids)
+    write_unique_articulations(
+        writer.paths["full"], os.path.join(pred_path, "articulations-unique.jsonl")
+    )
+
+
+def read_files(pred_path):
+    names = list(ARTICULATION_FILES.values()) + ["articulations-unique.jsonl"]
+    files = {}
+    for name in names:
+        with open(os.path.join(pred_path, name), "rb") as f:
+            files[name] = f.read()
+    return files
+
+
+def test_resume_after_misses_matches_straight_run(tmp_path):
+    data, responses = build_data()
+    write_baseline(data, responses, str(tmp_path / "baseline"))
+    run(data, responses, str(tmp_path / "straight"))
+    # a replay that missed some examples, then a --resume run that adds them
+    missed = {"ex-0", "ex-5", "ex-6", "ex-21", "ex-39"}
+    run(data, responses, str(tmp_path / "resumed"), skip=missed)
+    run(data, responses, str(tmp_path / "resumed"), resume=True)
+
+    baseline = read_files(str(tmp_path / "baseline"))
+    assert read_files(str(tmp_path / "straight")) == baseline
+    assert read_files(str(tmp_path / "resumed")) == baseline
+
+
+def test_finish_rebuild_completes_interrupted_move(tmp_path):
+    data, responses = build_data()
+    pred_path = str(tmp_path / "predictions")
+    run(data[:10], responses[:10], pred_path)
+    run(data, responses, str(tmp_path / "full"))
+    expected = read_files(str(tmp_path / "full"))
+
+    # a rebuild that crashed after moving in only the responses
+    rebuild_path = pred_path + ".rebuild"
+    os.makedirs(rebuild_path)
+    for name in ARTICULATION_FILES.values():
+        with open(os.path.join(rebuild_path, name), "wb") as f:
+            f.write(expected[name])
+    open(os.path.join(rebuild_path, "done"), "w").close()
+    name = ARTICULATION_FILES["responses"]
+    os.replace(os.path.join(rebuild_path, name), os.path.join(pred_path, name))
+    finish_rebuild(pred_path)
+    assert not os.path.exists(rebuild_path)
+    for name in ARTICULATION_FILES.values():
+        assert read_files(pred_path)[name] == expected[name]
+
+    # an unfinished one is dropped, leaving the files as they were
+    os.makedirs(rebuild_path)
+    with open(os.path.join(rebuild_path, ARTICULATION_FILES["full"]), "w") as f:
+        f.write("partial")
+    ArticulationWriter(pred_path, resume=True).close()
+    assert not os.path.exists(rebuild_path)
+    assert read_files(pred_path)[ARTICULATION_FILES["full"]] != b"partial"